@@ -137,9 +137,13 @@ async function startServer() {
       const responsePayload = {
         name,
         response: {
-          content: JSON.stringify(result.structuredContent || result.message || "Execution complete.")
+          content: JSON.stringify(result.content || result.message || "Execution complete.")
         }
       };
+      // Servers that return structured results (e.g. local_rag) get them passed alongside the text.
+      if (result.structuredContent && result.structuredContent !== result.content) {
+        responsePayload.response.structuredContent = result.structuredContent;
+      }
       res.json({ functionResponse: responsePayload });
     } catch (error) {
       console.error(`[Gateway/Gemini] Error executing tool '${name}':`, error);
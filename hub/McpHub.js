@@ -454,7 +454,7 @@ export class McpHub {
     return {
       ok,
       content: result?.content || null,
-      structuredContent: result?.content || null,
+      structuredContent: result?.structuredContent || result?.content || null,
       isError: result?.isError || false,
       message: message || (ok ? 'Completed.' : result?.message || null),
     };
@@ -6,11 +6,110 @@ import os
 import traceback
 import pickle
 import base64
+import hashlib
+import codecs
+import io
+import shutil
+import operator
+import re
+import math
+import heapq
+import bisect
+import fnmatch
+import mmap
+import tempfile
+import threading
+import itertools
+import weakref
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime
-from difflib import SequenceMatcher
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; ranked search falls back to pure Python scoring.
+    np = None
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 CHUNK_WORDS = 500
 CHUNK_OVERLAP = 50
+# Files are chunked from a stream of whitespace-separated words (exactly what str.split
+# splits on), read STREAM_BLOCK_SIZE bytes at a time once a file is in streaming mode.
+SPACE_SPLIT_RE = re.compile(r"(\s+)")
+STREAM_BLOCK_SIZE = 1 << 20
+# Tags are looked for in the first lines of a file, within this many bytes.
+TAG_PEEK_BYTES = 1 << 16
+# Inverted-index terms are lowercased runs of word characters.
+WORD_RE = re.compile(r"\w+")
+# Case-insensitive regex matching also equates these characters (see sre_compile);
+# trigrams are taken over lowercased text with them folded to one representative.
+CASE_EQUIVALENTS = str.maketrans({
+    "\u0131": "i", "\u017f": "s", "\u00b5": "\u03bc", "\u0345": "\u03b9", "\u1fbe": "\u03b9",
+    "\u03c2": "\u03c3", "\u03d0": "\u03b2", "\u03d1": "\u03b8", "\u03d5": "\u03c6", "\u03d6": "\u03c0",
+    "\u03f0": "\u03ba", "\u03f1": "\u03c1", "\u03f5": "\u03b5", "\u1e9b": "\u1e61", "\ufb05": "\ufb06",
+})
+# Characters whose str.lower() is longer than their simple lowercase, which is what
+# regexes compare; they are mapped to the simple lowercase before lowercasing.
+SIMPLE_LOWER = str.maketrans({"\u0130": "i"})
+# Fuzzy search maps query words to vocabulary terms within this many edits,
+# looked up through a SymSpell-style deletion dictionary over term prefixes.
+FUZZY_MAX_EDITS = 2
+FUZZY_PREFIX = 7
+DELETION_KEY_BASE = 1000003
+# Default snippet width in characters; snippets are centred on the best cluster of matches.
+SNIPPET_WIDTH = 300
+# get_context estimates token counts as characters / CHARS_PER_TOKEN.
+CHARS_PER_TOKEN = 4
+# read_file returns at most this many KB per call; larger files are paged with a cursor.
+READ_MAX_BYTES = int(float(os.environ.get('RAG_READ_MAX_KB') or 256) * 1024)
+# Line breaks read_file counts lines by and returns as \n.
+LINE_BREAK_RE = re.compile(rb"\r\n?|\n")
+# Default page size of list_files; larger directories are paged with a cursor.
+LIST_PAGE_SIZE = 1000
+# Keyword searches return this many hits when no limit is given; more are paged with offset.
+SEARCH_PAGE_SIZE = 100
+# Okapi BM25 parameters for ranked search.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# search_index modes: keyword matching (literal, fuzzy, regex or BM25), vector similarity,
+# or both combined.
+SEARCH_MODES = ("keyword", "vector", "hybrid")
+# Vector mode embeds chunks as hashed TF-IDF vectors over their words and the words'
+# character trigrams, VECTOR_DIM float32 values each. When VECTOR_HASH_DIM is larger,
+# features are hashed into that many buckets first and reduced to VECTOR_DIM by a
+# random projection seeded with VECTOR_SEED; otherwise they are hashed straight in.
+VECTOR_DIM = int(os.environ.get('RAG_VECTOR_DIM') or 1024)
+VECTOR_HASH_DIM = int(os.environ.get('RAG_VECTOR_HASH_DIM') or 0)
+VECTOR_SEED = 1729
+# Vector and hybrid searches return this many hits when no limit is given.
+VECTOR_TOP_K = 10
+# Hybrid search fuses the BM25 and vector rankings by reciprocal rank fusion, scoring
+# each chunk sum(1 / (RRF_K + rank)); each ranking contributes at least its HYBRID_DEPTH best.
+RRF_K = 60
+HYBRID_DEPTH = 100
+# Near-duplicate detection: a MinHash signature (MINHASH_SIZE values) of each chunk's set
+# of words, made at index time, and LSH over MINHASH_BANDS bands of the signature to find
+# candidate pairs, which are kept when their estimated Jaccard similarity is at least the
+# threshold.
+MINHASH_SIZE = 64
+MINHASH_BANDS = 16
+DUPLICATE_THRESHOLD = 0.8
+# Boolean queries (search_index boolean=True): words, "quoted phrases", parentheses, the
+# upper-case operators AND, OR and NOT (adjacent terms are ANDed) and QUERY_FIELDS filters
+# written field:value or field:"quoted value".
+QUERY_FIELDS = ("path", "tag", "after", "before")
+QUERY_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<paren>[()])|"(?P<phrase>[^"]*)"'
+    r'|(?P<field>' + "|".join(QUERY_FIELDS) + r'):(?:"(?P<quoted>[^"]*)"|(?P<value>[^\s()"]+))'
+    r'|(?P<word>[^\s()"]+))'
+)
 
 # =============================================================================
 # 1. MCP Server Framework
@@ -18,10 +117,36 @@ CHUNK_OVERLAP = 50
 
 logging.basicConfig(level=logging.INFO, format='[RAG-MCP-PY] %(levelname)s: %(message)s')
 
+# Tool calls run on this many worker threads, so a long create_index does not hold up other requests.
+REQUEST_WORKERS = int(os.environ.get('RAG_REQUEST_WORKERS') or 4)
+
+
+class RequestCancelled(Exception):
+    """Raised inside a tool call whose request the client cancelled."""
+
+
+# Cancellation event of the request handled by the current worker thread, if any.
+_request_context = threading.local()
+
+
+def cancel_requested() -> bool:
+    cancelled = getattr(_request_context, "cancelled", None)
+    return cancelled is not None and cancelled.is_set()
+
+
+def check_cancelled():
+    """Called by long-running tools between steps; aborts the call once it is cancelled."""
+    if cancel_requested():
+        raise RequestCancelled()
+
 # ... (StdioComms, Tool, ToolManager classes remain the same) ...
 
 class StdioComms:
     """Handles JSON-RPC communication over stdin/stdout."""
+    def __init__(self):
+        # Responses are written from several worker threads; one line must not interleave with another.
+        self._write_lock = threading.Lock()
+
     def read_message(self):
         line = sys.stdin.readline()
         if not line:
@@ -30,8 +155,9 @@ class StdioComms:
 
     def write_message(self, message):
         serialized = json.dumps(message)
-        sys.stdout.write(serialized + '\n')
-        sys.stdout.flush()
+        with self._write_lock:
+            sys.stdout.write(serialized + '\n')
+            sys.stdout.flush()
 
 class Tool:
     def __init__(self, name, description, func, input_schema=None):
@@ -66,6 +192,10 @@ class Server:
     def __init__(self):
         self._comms = StdioComms()
         self._tool_manager = ToolManager()
+        self._executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="rag-request")
+        # Cancellation events of tool calls that are queued or running, keyed by request id.
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
         # Path sandboxing is disabled by default in dev; set RAG_ALLOWED_BASE_PATH to re-enable.
         env_base = os.environ.get('RAG_ALLOWED_BASE_PATH')
         self.allowed_base_path = os.path.abspath(env_base) if env_base else BASE_DATA_DIR
@@ -87,15 +217,52 @@ class Server:
                 request = self._comms.read_message()
                 if request is None:
                     break
-                self.handle_request(request)
+                self.dispatch(request)
             except json.JSONDecodeError:
                 logging.error("Failed to decode JSON message.")
                 continue
             except Exception as e:
                 logging.error(f"Critical error in server loop: {e}")
                 break
+        # Let calls that are already running finish and send their responses.
+        self._executor.shutdown(wait=True)
         logging.info("RAG Server shutting down.")
-        
+
+    def dispatch(self, request):
+        """
+        Runs tool calls on the worker pool, so their responses go out in completion order
+        (clients match them up by id); everything else is answered straight away.
+        """
+        method = request.get('method')
+        params = request.get('params') or {}
+        if method == 'notifications/cancelled':
+            with self._in_flight_lock:
+                cancelled = self._in_flight.get(params.get('requestId'))
+            if cancelled is not None:
+                logging.info(f"Cancelling request {params.get('requestId')}: {params.get('reason', 'no reason given')}")
+                cancelled.set()
+            return
+        msg_id = request.get('id')
+        if method != 'tools/call' or msg_id is None:
+            self.handle_request(request)
+            return
+        cancelled = threading.Event()
+        with self._in_flight_lock:
+            self._in_flight[msg_id] = cancelled
+        self._executor.submit(self._run_request, request, cancelled)
+
+    def _run_request(self, request, cancelled):
+        _request_context.cancelled = cancelled
+        try:
+            if not cancelled.is_set():
+                self.handle_request(request)
+        except Exception as e:
+            logging.error(f"Unhandled error for request {request.get('id')}: {e}")
+        finally:
+            _request_context.cancelled = None
+            with self._in_flight_lock:
+                self._in_flight.pop(request.get('id'), None)
+
     def _is_path_safe(self, path_to_check):
         """Checks if the provided path is within the allowed base directory."""
         if not self.allowed_base_path:
@@ -135,12 +302,23 @@ class Server:
             
             try:
                 result_content = tool.func(**args)
-                response['result'] = {"content": result_content}
+                # Tools return a content list, or a full result with structuredContent as well.
+                if isinstance(result_content, dict):
+                    response['result'] = result_content
+                else:
+                    response['result'] = {"content": result_content}
+            except RequestCancelled:
+                # Cancelled requests get no response.
+                logging.info(f"Tool '{tool_name}' call {msg_id} was cancelled.")
+                return
             except Exception as e:
                 tb_str = traceback.format_exc()
                 logging.error(f"Error calling tool '{tool_name}': {e}\n{tb_str}")
                 response['error'] = {"code": -32000, "message": f"Error executing tool: {e}"}
-            
+
+            if cancel_requested():
+                logging.info(f"Tool '{tool_name}' call {msg_id} was cancelled.")
+                return
             self._comms.write_message(response)
 
         elif method == 'initialize':
@@ -164,11 +342,45 @@ class Server:
 # 2. RAG Tool Implementations
 # =============================================================================
 
-# In-memory storage for multiple, named file indexes.
+# In-memory storage for multiple, named file indexes (bodies are loaded on first use).
 file_indexes = {}
+# Persisted index metadata, keyed by index name; mirrors the on-disk manifest.
+index_manifest = {}
 # Base data directory inside repo: ../data/rag
 BASE_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "rag"))
+# Each index is persisted as its own versioned segment file, listed in a small manifest.
+SEGMENTS_DIR = os.path.join(BASE_DATA_DIR, "segments")
+MANIFEST_FILE = os.path.join(SEGMENTS_DIR, "manifest.json")
+SEGMENT_FORMAT = 7
+# Single-pickle snapshot of every index used before segments; migrated once on startup.
 PERSISTENCE_FILE = os.path.join(BASE_DATA_DIR, "indexes.pkl")
+# Optional resident-memory budget in MB; when exceeded, the least recently used
+# loaded indexes are evicted and transparently reloaded from their segments.
+MEMORY_BUDGET_MB = float(os.environ.get('RAG_MEMORY_BUDGET_MB') or 0)
+# Worker processes for reading and analyzing files in create_index (1 = in-process).
+INDEX_WORKERS = int(os.environ.get('RAG_INDEX_WORKERS') or os.cpu_count() or 1)
+# Each worker process needs at least this many bytes of files to analyze; smaller jobs
+# use fewer workers, or none, since a spawned worker takes about a second to start.
+PARALLEL_INDEX_MIN_BYTES = 8 << 20
+# Files larger than this many MB are chunked in streaming mode: read block by block, with
+# their packed text spooled to disk, so the file's text is never held in memory whole.
+STREAM_FILE_MB = float(os.environ.get('RAG_STREAM_FILE_MB') or 64)
+# NumPy analysis tokenizes and sorts chunks in batches of about this many tokens.
+ANALYZE_BATCH_TOKENS = 1 << 18
+# Size of the search_index result cache in MB (0 disables it).
+RESULT_CACHE_MB = float(os.environ.get('RAG_RESULT_CACHE_MB') or 32)
+# Names of indexes evicted to stay under the memory budget (cleared when reloaded).
+evicted_indexes = set()
+# Guards changes to file_indexes, index_manifest and evicted_indexes across request threads.
+# Readers take no lock: a loaded index is fetched with one dict lookup and kept for the
+# whole call, and since indexes are immutable a rebuild (a new generation, swapped in
+# with one assignment) never disturbs searches already running on the old one.
+index_lock = threading.RLock()
+# Last-use tick per loaded index, for least-recently-used eviction.
+index_last_used = {}
+_use_clock = itertools.count(1)
+# One lock per index name, so concurrent create_index calls for one index run one at a time.
+build_locks = {}
 
 def normalize_path(p: str) -> str:
     if not p:
@@ -181,27 +393,192 @@ def ensure_persistence_dir():
     """Makes sure the vector persistence directory exists before reading/writing."""
     os.makedirs(os.path.dirname(PERSISTENCE_FILE), exist_ok=True)
     # Ensure common subfolders exist for future use (uploads, saved_chats, indexes, images)
-    for sub in ("uploads", "saved_chats", "indexes", "images"):
+    for sub in ("uploads", "saved_chats", "indexes", "images", "segments"):
         os.makedirs(os.path.join(BASE_DATA_DIR, sub), exist_ok=True)
 
 
-def chunk_text(text: str, max_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP):
+# Code point -> is whitespace for str.split, for locating words with NumPy (no code
+# point above U+3000 is whitespace).
+SPACE_TABLE = None if np is None else np.array([chr(c).isspace() for c in range(0x3002)], dtype=bool)
+
+
+def word_offsets(text: str, text_pos: int):
     """
-    Split text into word-based chunks with overlap.
+    Byte (starts, ends) in the file of the words of text, which starts at byte text_pos,
+    as NumPy arrays in the order str.split returns the words.
     """
-    words = text.split()
-    if not words:
-        return []
-    chunks = []
-    start = 0
-    while start < len(words):
-        end = min(len(words), start + max_words)
-        chunk_words = words[start:end]
-        chunks.append(" ".join(chunk_words))
-        if end == len(words):
-            break
-        start = max(0, end - overlap)
-    return chunks
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    space = np.concatenate([[True], SPACE_TABLE[np.minimum(codes, 0x3001)], [True]])
+    starts = np.flatnonzero(space[:-1] & ~space[1:])
+    ends = np.flatnonzero(~space[:-1] & space[1:])
+    if not text.isascii():
+        widths = 1 + (codes >= 0x80).astype(np.int64) + (codes >= 0x800) + (codes >= 0x10000)
+        byte_at = np.concatenate([[0], np.cumsum(widths)])
+        starts, ends = byte_at[starts], byte_at[ends]
+    return starts + text_pos, ends + text_pos
+
+
+def iter_word_blocks(f, block_size: int = STREAM_BLOCK_SIZE):
+    """
+    Yield (words, byte starts, byte ends) lists for the words str.split would find in the
+    UTF-8 text of a binary file, decoding it block by block. Only a word straddling a
+    block boundary is held back, so memory stays around one block (a single word longer
+    than a block is cut there).
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    carry = ""
+    text_pos = 0  # byte offset of the start of text in the file
+    while True:
+        block = f.read(block_size)
+        final = not block
+        text = carry + decoder.decode(block, final)
+        carry = ""
+        if np is not None:
+            words = text.split()
+            starts, ends = word_offsets(text, text_pos)
+            end_pos = text_pos + (len(text) if text.isascii() else len(text.encode('utf-8')))
+            if not final and words and ends[-1] == end_pos and len(words[-1]) <= block_size:
+                carry = words.pop()
+                end_pos = int(starts[-1])
+                starts, ends = starts[:-1], ends[:-1]
+            starts, ends = starts.tolist(), ends.tolist()
+        else:
+            # Alternating word, whitespace, word, ...; the first and last words may be empty.
+            parts = SPACE_SPLIT_RE.split(text)
+            if not final and parts[-1] and len(parts[-1]) <= block_size:
+                carry = parts.pop()
+            sizes = list(map(len, parts)) if text.isascii() else list(map(len, map(str.encode, parts)))
+            offsets = list(itertools.accumulate(sizes, initial=text_pos))
+            words, starts = parts[0::2], offsets[0:-1:2]
+            ends = list(map(operator.add, starts, sizes[0::2]))
+            if words and not words[-1]:
+                del words[-1], starts[-1], ends[-1]
+            if words and not words[0]:
+                del words[0], starts[0], ends[0]
+            end_pos = offsets[-1]
+        if words:
+            yield words, starts, ends
+        text_pos = end_pos
+        if final:
+            return
+
+
+def stream_chunks(f, block_size: int = STREAM_BLOCK_SIZE, out=None, max_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP):
+    """
+    Chunk a binary text file into runs of max_words words, each starting overlap words
+    before the previous one ended, as a generator of (words, file byte start, file byte
+    end, packed start, packed end) per chunk, where packed offsets are into the UTF-8
+    " ".join of all the file's words. When out is given, that packed text is written to
+    it as the file is read. Only the current block and the words of an unfinished chunk
+    are held in memory.
+    """
+    words, starts, ends, packed = [], [], [], []
+    packed_pos = 0
+    emitted = False
+    for block_words, block_starts, block_ends in iter_word_blocks(f, block_size):
+        lengths = list(map(operator.sub, block_ends, block_starts))
+        # Word i of the block starts after the previous words and one space per word.
+        block_packed = list(map(operator.add, itertools.accumulate(lengths, initial=packed_pos), itertools.count()))
+        packed_pos = block_packed.pop()
+        if out is not None:
+            out.write(((" " if block_packed[0] else "") + " ".join(block_words)).encode('utf-8'))
+        words += block_words
+        starts += block_starts
+        ends += block_ends
+        packed += block_packed
+        at = 0
+        while len(words) - at > max_words:
+            hi = at + max_words
+            yield words[at:hi], starts[at], ends[hi - 1], packed[at], packed[hi - 1] + ends[hi - 1] - starts[hi - 1]
+            emitted = True
+            at = max(at + 1, hi - overlap)
+        if at:
+            del words[:at], starts[:at], ends[:at], packed[:at]
+    if words and (not emitted or len(words) > overlap):
+        yield words, starts[0], ends[-1], packed[0], packed[-1] + ends[-1] - starts[-1]
+
+
+class TextStore:
+    """
+    Packed UTF-8 text of one index, memory-mapped read-only. Chunks are
+    (start, end) byte ranges into it and are only decoded when needed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.getsize(path):
+            with open(path, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b""
+
+    def read(self, start: int, end: int) -> bytes:
+        return self._data[start:end]
+
+    def text(self, start: int, end: int) -> str:
+        return self._data[start:end].decode('utf-8')
+
+    def contains(self, data: bytes) -> bool:
+        return self._data.find(data) != -1
+
+    def rename(self, path: str):
+        """Move the backing file; the existing mapping stays valid."""
+        os.replace(self.path, path)
+        self.path = path
+
+    def retire(self):
+        """Delete the backing file once this store is garbage, i.e. its last reader is done."""
+        weakref.finalize(self, release_store, self._data, self.path)
+
+
+def release_store(data, path: str):
+    if isinstance(data, mmap.mmap):
+        data.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class TextStoreWriter:
+    """Appends text for a new TextStore to a temporary file in the segments directory."""
+    def __init__(self):
+        ensure_persistence_dir()
+        fd, self.path = tempfile.mkstemp(prefix="build-", suffix=".txt", dir=SEGMENTS_DIR)
+        self._file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def append(self, data: bytes) -> int:
+        """Write data and return the offset it starts at."""
+        offset = self.size
+        self._file.write(data)
+        self.size += len(data)
+        return offset
+
+    def append_file(self, path: str) -> int:
+        """Append the contents of a file, block by block, and return its offset."""
+        offset = self.size
+        with open(path, 'rb') as src:
+            shutil.copyfileobj(src, self._file, STREAM_BLOCK_SIZE)
+            self.size += src.tell()
+        return offset
+
+    def append_range(self, store: TextStore, start: int, end: int) -> int:
+        """Append a byte range of another store, block by block, and return its offset."""
+        offset = self.size
+        for lo in range(start, end, STREAM_BLOCK_SIZE):
+            self.append(store.read(lo, min(end, lo + STREAM_BLOCK_SIZE)))
+        return offset
+
+    def close(self) -> TextStore:
+        self._file.close()
+        return TextStore(self.path)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
 
 def extract_tags(text: str):
@@ -218,217 +595,2902 @@ def extract_tags(text: str):
     return tags
 
 
-def fuzzy_match(query: str, text: str, threshold: float = 0.45):
+def deletes(word: str, max_edits: int):
+    """All strings obtained from word by deleting up to max_edits characters."""
+    found = {word}
+    frontier = {word}
+    for _ in range(max_edits):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        found |= frontier
+    return found
+
+
+def deletion_key(word: str) -> int:
+    """64-bit polynomial hash of a string as a signed integer, the key deletion_table files it under."""
+    key = 0
+    for ch in word:
+        key = (key * DELETION_KEY_BASE + ord(ch)) & 0xFFFFFFFFFFFFFFFF
+    return key - ((key >> 63) << 64)
+
+
+def deletion_table(terms):
     """
-    Fuzzy match that tolerates short misspellings by checking sliding word windows.
+    SymSpell-style deletion dictionary of terms as two arrays sorted by key: the
+    deletion_key of each string within FUZZY_MAX_EDITS deletions of a term's first
+    FUZZY_PREFIX characters, and that term's id. A key collision only adds a candidate,
+    which fuzzy_terms checks by edit distance anyway.
+
+    With NumPy the keys are hashed for all terms at once, one deletion pattern (set of
+    deleted positions) at a time, over the prefixes' code points padded with zeros,
+    which are skipped. A pattern is only used for prefixes long enough to delete all
+    of its positions.
     """
-    q = (query or "").lower()
-    t = (text or "").lower()
-    if not q or not t:
-        return False
-    if q in t:
-        return True
-    if len(q) < 3:
-        return False
-
-    # Sliding window over words near the query length to avoid ratio dilution on long chunks
-    q_words = q.split()
-    tokens = t.split()
-    if tokens and q_words:
-        win = max(1, min(len(tokens), len(q_words) + 2))
-        for i in range(0, max(1, len(tokens) - win + 1)):
-            segment = " ".join(tokens[i : i + win])
-            if SequenceMatcher(None, q, segment).ratio() >= threshold:
+    if np is None:
+        pairs = sorted((deletion_key(key), tid) for tid, term in enumerate(terms)
+                       for key in deletes(term[:FUZZY_PREFIX], FUZZY_MAX_EDITS))
+        return array('q', [key for key, _ in pairs]), array('i', [tid for _, tid in pairs])
+    width = FUZZY_PREFIX
+    padded = "".join(term[:width].ljust(width, "\0") for term in terms)
+    codes = np.frombuffer(padded.encode('utf-32-le'), dtype=np.uint32).reshape(len(terms), width).astype(np.uint64)
+    lengths = np.count_nonzero(codes, axis=1)
+    patterns = [deleted for edits in range(FUZZY_MAX_EDITS + 1) for deleted in itertools.combinations(range(width), edits)]
+    uses = [lengths > max(deleted, default=-1) for deleted in patterns]
+    keys = np.empty(sum(int(np.count_nonzero(use)) for use in uses), dtype=np.uint64)
+    tids = np.empty(len(keys), dtype=np.intc)
+    base = np.uint64(DELETION_KEY_BASE)
+    at = 0
+    for deleted, use in zip(patterns, uses):
+        rows = np.flatnonzero(use)
+        key = np.zeros(len(rows), dtype=np.uint64)
+        for column in range(width):
+            if column not in deleted:
+                code = codes[rows, column]
+                key = np.where(code > 0, key * base + code, key)
+        keys[at:at + len(rows)] = key
+        tids[at:at + len(rows)] = rows
+        at += len(rows)
+    keys = keys.view(np.int64)
+    tids = tids[np.argsort(keys, kind="stable")]
+    keys.sort()
+    return keys, tids
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Optimal string alignment distance (Levenshtein plus adjacent transpositions),
+    or limit + 1 as soon as it is known to exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost)
+            if prev2 is not None and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], prev2[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        prev2, prev = prev, row
+    return prev[-1]
+
+
+def within_window(position_lists, window: int) -> bool:
+    """True if one position can be picked from each list so that they all fit in window words."""
+    merged = sorted((pos, k) for k, plist in enumerate(position_lists) for pos in plist)
+    need = len(position_lists)
+    counts = [0] * need
+    covered = 0
+    lo = 0
+    for pos, k in merged:
+        counts[k] += 1
+        if counts[k] == 1:
+            covered += 1
+        while covered == need:
+            if pos - merged[lo][0] < window:
                 return True
+            counts[merged[lo][1]] -= 1
+            if counts[merged[lo][1]] == 0:
+                covered -= 1
+            lo += 1
+    return False
 
-    # Fallback on full text ratio
-    return SequenceMatcher(None, q, t).ratio() >= threshold
 
-def save_state():
-    """Saves the current file_indexes to disk using an atomic write."""
-    ensure_persistence_dir()
-    tmp_file = PERSISTENCE_FILE + ".tmp"
+def fold_case(text: str) -> str:
+    """Lowercase text for the trigram index, folding characters regexes treat as equal."""
+    text = text or ""
+    if text.isascii():
+        return text.lower()
+    return text.translate(SIMPLE_LOWER).lower().translate(CASE_EQUIVALENTS)
+
+
+def trigrams(text: str):
+    """Distinct byte trigrams of fold_case(text), as 24-bit ints."""
+    data = fold_case(text).encode('utf-8')
+    return {int.from_bytes(data[i:i + 3], 'big') for i in range(len(data) - 2)}
+
+
+def regex_literals(parsed):
+    """
+    Literal strings a match of a parsed regex must contain, as an AND-list whose items
+    are either a string or ('or', [AND-list per alternative]). Anything that is not a
+    plain literal just ends the current run, so the list is a necessary condition only.
+    """
+    required = []
+    run = []
+
+    def flush():
+        if run:
+            required.append("".join(run))
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        if op is sre_parse.SUBPATTERN:
+            required.extend(regex_literals(av[-1]))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+            if av[0] >= 1:
+                required.extend(regex_literals(av[2]))
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            required.extend(regex_literals(av))
+        elif op is sre_parse.BRANCH:
+            alternatives = [regex_literals(alt) for alt in av[1]]
+            if all(alternatives):
+                required.append(("or", alternatives))
+    flush()
+    return required
+
+
+def tokenize(text: str):
+    """
+    Split text into the lowercased word terms used by the inverted index.
+    """
+    return WORD_RE.findall((text or "").lower())
+
+
+def token_spans(text: str, positions):
+    """Character spans in text of the tokens at the given token positions (see tokenize)."""
+    wanted = set(positions)
+    if not wanted:
+        return []
+    last = max(wanted)
+    spans = []
+    for pos, match in enumerate(WORD_RE.finditer(text)):
+        if pos in wanted:
+            spans.append(match.span())
+        if pos >= last:
+            break
+    return spans
+
+
+def make_snippet(text: str, spans, width: int = SNIPPET_WIDTH):
+    """
+    Cut a snippet of about width characters out of text, centred on the window holding the
+    most distinct matched words (then the most matches) and with the matches in **bold**.
+    spans are (start, end) character offsets of the matches. Returns the snippet, its
+    (start, end) offsets in text and the match spans it contains.
+    """
+    width = max(1, int(width or SNIPPET_WIDTH))
+    spans = sorted(set(spans))
+    if not spans:
+        first = last = start = 0
+        end = min(len(text), width)
+    else:
+        best = None
+        hi = 0
+        for lo in range(len(spans)):
+            hi = max(hi, lo)
+            while hi + 1 < len(spans) and spans[hi + 1][1] - spans[lo][0] <= width:
+                hi += 1
+            window = spans[lo:hi + 1]
+            score = (len({text[a:b].lower() for a, b in window}), len(window))
+            if best is None or score > best[0]:
+                best = (score, window[0][0], window[-1][1])
+        _, first, last = best
+        pad = max(0, width - (last - first)) // 2
+        start = max(0, first - pad)
+        end = min(len(text), max(last, start + width))
+        start = max(0, min(start, end - width))
+    # Do not cut words in half at either edge.
+    if start > 0 and text[start - 1] != " ":
+        cut = text.find(" ", start, first)
+        if cut != -1:
+            start = cut + 1
+    if end < len(text) and text[end] != " ":
+        cut = text.rfind(" ", last, end)
+        if cut != -1:
+            end = cut
+    shown = [(max(a, start), min(b, end)) for a, b in spans if a < end and b > start]
+    pieces = ["..." if start > 0 else ""]
+    at = start
+    for a, b in shown:
+        pieces += [text[at:a], "**", text[a:b], "**"]
+        at = b
+    pieces += [text[at:end], "..." if end < len(text) else ""]
+    return "".join(pieces), (start, end), shown
+
+
+def trigram_codes(text: str):
+    """Sorted distinct trigram codes of a chunk, as produced by trigrams()."""
+    if np is None:
+        return sorted(trigrams(text))
+    data = np.frombuffer(fold_case(text).encode('utf-8'), dtype=np.uint8).astype(np.int32)
+    if len(data) < 3:
+        return np.zeros(0, dtype=np.intc)
+    # Sorting and dropping repeats is much faster than np.unique on arrays this small.
+    codes = np.sort((data[:-2] << 16) | (data[1:-1] << 8) | data[2:])
+    return codes[np.concatenate([[True], codes[1:] != codes[:-1]])].astype(np.intc)
+
+
+def vector_space() -> int:
+    """Number of hash buckets features are hashed into (see VECTOR_HASH_DIM)."""
+    return max(VECTOR_HASH_DIM, VECTOR_DIM)
+
+
+_projections = {}
+
+
+def projection():
+    """The seeded Gaussian random projection from vector_space() buckets to VECTOR_DIM."""
+    key = (vector_space(), VECTOR_DIM)
+    matrix = _projections.get(key)
+    if matrix is None:
+        rng = np.random.default_rng(VECTOR_SEED)
+        matrix = _projections[key] = rng.standard_normal(key, dtype=np.float32) / np.float32(math.sqrt(VECTOR_DIM))
+    return matrix
+
+
+def mix_hash(x):
+    """Scramble uint64 values (splitmix64 finalizer) so nearby inputs land far apart."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def feature_table(terms):
+    """
+    Hashed features of each term for vector search, CSR-style: term t owns entries
+    ptr[t]:ptr[t+1] of (bucket, value). The features are the word itself (weight 1) and
+    the byte trigrams of "<term>" (weight 1 together), each with a hash-derived sign.
+    Hashes depend only on the term and VECTOR_SEED, so they are stable across processes.
+    """
+    n = len(terms)
+    words = mix_hash(np.fromiter((zlib.crc32(t.encode('utf-8'), VECTOR_SEED) for t in terms), dtype=np.uint64, count=n))
+    padded = [("<" + t + ">").encode('utf-8') for t in terms]
+    lens = np.fromiter(map(len, padded), dtype=np.int64, count=n)
+    data = np.frombuffer(b"".join(padded), dtype=np.uint8).astype(np.uint64)
+    grams = np.maximum(lens - 2, 0)
+    firsts = np.repeat(np.cumsum(lens) - lens, grams)
+    starts = firsts + np.arange(int(grams.sum())) - np.repeat(np.cumsum(grams) - grams, grams)
+    codes = (data[starts] << np.uint64(16)) | (data[starts + 1] << np.uint64(8)) | data[starts + 2]
+    gram_hashes = mix_hash(codes + np.uint64(VECTOR_SEED << 32))
+
+    # Each term's word feature followed by its trigrams.
+    counts = grams + 1
+    ptr = np.concatenate([[0], np.cumsum(counts)])
+    hashes = np.empty(int(ptr[-1]), dtype=np.uint64)
+    values = np.empty(int(ptr[-1]), dtype=np.float64)
+    is_word = np.zeros(int(ptr[-1]), dtype=bool)
+    is_word[ptr[:-1]] = True
+    hashes[is_word], hashes[~is_word] = words, gram_hashes
+    values[is_word], values[~is_word] = 1.0, np.repeat(1.0 / np.sqrt(np.maximum(grams, 1)), grams)
+    signs = np.where((hashes >> np.uint64(63)).astype(bool), 1.0, -1.0)
+    return ptr, (hashes % np.uint64(vector_space())).astype(np.int64), values * signs
+
+
+def embed(rows, n_rows: int, tids, weights, table):
+    """
+    L2-normalized float32 vectors (n_rows x VECTOR_DIM) from weighted (row, term id)
+    pairs, each term contributing its features from feature_table.
+    """
+    ptr, buckets, values = table
+    space = vector_space()
+    counts = ptr[tids + 1] - ptr[tids]
+    owner = np.repeat(np.arange(len(tids)), counts)
+    feature = np.repeat(ptr[tids] - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+    dense = np.bincount(rows[owner] * space + buckets[feature], weights=weights[owner] * values[feature],
+                        minlength=n_rows * space).reshape(n_rows, space).astype(np.float32)
+    if space > VECTOR_DIM:
+        dense = dense @ projection()
+    norms = np.linalg.norm(dense, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return dense / norms
+
+
+def minhash_signatures(terms, post_term, post_chunk, n_chunks: int):
+    """
+    MinHash signatures (n_chunks x MINHASH_SIZE uint32) of each chunk's set of terms,
+    from (term id into terms, chunk) postings, by one-permutation hashing: one hash per
+    term picks a bin and a 24-bit value, each bin keeps its minimum, and empty bins take
+    the next non-empty bin's value plus the distance (rotation densification). Chunks
+    without terms keep all-ones signatures and are never treated as duplicates.
+    """
+    size = MINHASH_SIZE
+    signatures = np.full(n_chunks * size, 0xFFFFFFFF, dtype=np.uint32)
+    post_term = np.asarray(post_term, dtype=np.int64)
+    if not len(post_term):
+        return signatures.reshape(n_chunks, size)
+    base = np.fromiter((zlib.crc32(t.encode('utf-8')) for t in terms), dtype=np.uint64, count=len(terms))
+    hashes = mix_hash(base + np.uint64(VECTOR_SEED))[post_term]
+    cells = np.asarray(post_chunk, dtype=np.int64) * size + (hashes % np.uint64(size)).astype(np.int64)
+    np.minimum.at(signatures, cells, (hashes >> np.uint64(40)).astype(np.uint32))
+    signatures = signatures.reshape(n_chunks, size)
+
+    empty = signatures == 0xFFFFFFFF
+    rows = np.flatnonzero(empty.any(axis=1) & ~empty.all(axis=1))
+    if len(rows):
+        doubled = np.concatenate([signatures[rows], signatures[rows]], axis=1)
+        filled = ~np.concatenate([empty[rows], empty[rows]], axis=1)
+        at = np.where(filled, np.arange(2 * size), 2 * size)
+        following = np.minimum.accumulate(at[:, ::-1], axis=1)[:, ::-1][:, :size]
+        distance = (following - np.arange(size)).astype(np.uint32)
+        signatures[rows] = np.take_along_axis(doubled, following, axis=1) + (distance << np.uint32(24))
+    return signatures
+
+
+def analyze_texts(texts):
+    """
+    Tokenize chunk texts into a postings fragment: a local term list plus flat
+    (term, chunk, tf) postings with their token positions, each chunk's length, its
+    trigram codes and, with NumPy, its MinHash signature. Chunks are numbered from 0
+    in the order given; RagIndex merges fragments into the index.
+    """
+    if np is not None:
+        return analyze_texts_np(texts)
+    local = {}
+    fragment = {name: array('i') for name in (
+        "post_term", "post_chunk", "post_tf", "positions", "doc_len", "tri_keys", "tri_chunk")}
+    for chunk, text in enumerate(texts):
+        tokens = tokenize(text)
+        fragment["doc_len"].append(len(tokens))
+        by_term = {}
+        for pos, term in enumerate(tokens):
+            by_term.setdefault(term, []).append(pos)
+        for term, plist in by_term.items():
+            fragment["post_term"].append(local.setdefault(term, len(local)))
+            fragment["post_chunk"].append(chunk)
+            fragment["post_tf"].append(len(plist))
+            fragment["positions"].extend(plist)
+        codes = trigram_codes(text)
+        fragment["tri_keys"].extend(codes)
+        fragment["tri_chunk"].extend(array('i', [chunk]) * len(codes))
+    fragment["terms"] = list(local)
+    return fragment
+
+
+def analyze_texts_np(texts):
+    """
+    NumPy version of analyze_texts. Chunks are analyzed in batches of about
+    ANALYZE_BATCH_TOKENS tokens whose postings are appended to the fragment's arrays
+    before the next batch is read, so a long stream of chunks only ever holds one
+    batch's tokens as strings.
+    """
+    local = {}
+    fragment = {name: array('i') for name in (
+        "post_term", "post_chunk", "post_tf", "positions", "doc_len", "tri_keys", "tri_chunk")}
+    minhash = bytearray()
+    words, codes, n_tokens = [], [], 0
+    for text in texts:
+        words.append(tokenize(text))
+        codes.append(trigram_codes(text))
+        n_tokens += len(words[-1])
+        if n_tokens >= ANALYZE_BATCH_TOKENS:
+            _analyze_batch(words, codes, local, fragment, minhash)
+            words, codes, n_tokens = [], [], 0
+    if words:
+        _analyze_batch(words, codes, local, fragment, minhash)
+    fragment["terms"] = list(local)
+    fragment["minhash"] = bytes(minhash)
+    return fragment
+
+
+def _analyze_batch(words, codes, local, fragment, minhash):
+    """
+    Append the postings of one batch of chunks (their token lists and trigram codes) to
+    a fragment. The batch's tokens are numbered through one dict and grouped into
+    postings by one stable sort on (chunk, term), which keeps each posting's positions
+    in order; local maps terms to fragment term ids in order of first appearance.
+    """
+    first = len(fragment["doc_len"])
+    doc_len = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    tokens = list(itertools.chain.from_iterable(words))
+    batch = {term: tid for tid, term in enumerate(dict.fromkeys(tokens))}
+    terms = list(batch)
+    tids = np.fromiter(map(batch.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+    del tokens
+    chunks = np.repeat(np.arange(len(doc_len)), doc_len)
+    positions = np.arange(len(tids)) - np.repeat(np.cumsum(doc_len) - doc_len, doc_len)
+    order = np.lexsort((tids, chunks))
+    keys = chunks[order] * max(1, len(terms)) + tids[order]
+    firsts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else np.zeros(0, dtype=np.int64)
+    post_term, post_chunk = tids[order][firsts], chunks[order][firsts]
+    minhash += minhash_signatures(terms, post_term, post_chunk, len(doc_len)).tobytes()
+    lookup = np.fromiter((local.setdefault(term, len(local)) for term in terms), dtype=np.int64, count=len(terms))
+    fragment["post_term"] += _to_array('i', lookup[post_term])
+    fragment["post_chunk"] += _to_array('i', post_chunk + first)
+    fragment["post_tf"] += _to_array('i', np.diff(np.append(firsts, len(keys))))
+    fragment["positions"] += _to_array('i', positions[order])
+    fragment["doc_len"] += _to_array('i', doc_len)
+    for chunk, chunk_codes in enumerate(codes, first):
+        fragment["tri_keys"] += _to_array('i', chunk_codes)
+        fragment["tri_chunk"] += array('i', [chunk]) * len(chunk_codes)
+
+
+def file_sha1(path: str) -> str:
+    """SHA-1 of a file's content, read block by block."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ordered_results(pool, fn, tasks, window: int):
+    """
+    Yield fn(task) for each task, in task order, running on pool with at most window
+    tasks submitted ahead of the consumer, so finished results do not pile up in memory.
+    """
+    tasks = iter(tasks)
+    pending = deque(pool.submit(fn, task) for task in itertools.islice(tasks, window))
+    while pending:
+        result = pending.popleft().result()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.submit(fn, task))
+        yield result
+
+
+def index_file(task):
+    """
+    Read, hash, chunk and analyze one file for create_index; runs in worker processes.
+    task is (path, known sha1 or None, size, spool directory). Only the hash is returned
+    when it matches the known one, and errors are returned rather than raised.
+
+    Files up to RAG_STREAM_FILE_MB are read whole and their packed text is returned as
+    bytes. Larger files are streamed: hashed in one pass, then chunked block by block
+    with the packed text written to a build- file in the spool directory ("packed_path").
+    """
+    file_path, known_sha1, size, spool_dir = task
+    spool = None
     try:
-        # Write to a temporary file first
-        with open(tmp_file, 'wb') as f:
-            pickle.dump(file_indexes, f)
-        
-        # Atomic rename: this guarantees the target file is either the old valid version
-        # or the new valid version, never a half-written corrupted version.
-        os.replace(tmp_file, PERSISTENCE_FILE)
-        logging.info(f"Indexes saved to {PERSISTENCE_FILE}")
+        with open(file_path, 'rb') as f:
+            streaming = size > STREAM_FILE_MB * 1024 * 1024
+            if streaming:
+                digest = file_sha1(file_path)
+                if digest == known_sha1:
+                    return {"sha1": digest}
+                f.seek(0)
+                source, block_size = f, STREAM_BLOCK_SIZE
+                fd, spool = tempfile.mkstemp(prefix="build-", suffix=".txt", dir=spool_dir)
+                out = os.fdopen(fd, 'wb')
+            else:
+                raw = f.read()
+                digest = hashlib.sha1(raw).hexdigest()
+                if digest == known_sha1:
+                    return {"sha1": digest}
+                source, block_size = io.BytesIO(raw), len(raw) + 1
+                out = io.BytesIO()
+            tags = extract_tags(source.read(TAG_PEEK_BYTES).decode('utf-8', errors='ignore'))
+            source.seek(0)
+
+            spans, sources = [], []
+
+            def chunk_texts():
+                for words, src_lo, src_hi, lo, hi in stream_chunks(source, block_size, out):
+                    spans.append((lo, hi))
+                    sources.append((src_lo, src_hi))
+                    yield " ".join(words)
+
+            fragment = analyze_texts(chunk_texts())
+        result = {"sha1": digest, "tags": tags, "spans": spans, "sources": sources, "fragment": fragment, "length": out.tell()}
+        if streaming:
+            out.close()
+            result["packed_path"], spool = spool, None
+        else:
+            result["packed"] = out.getvalue()
+        return result
     except Exception as e:
-        logging.error(f"Failed to save indexes: {e}")
-        # Clean up temp file if it exists
+        return {"error": str(e)}
+    finally:
+        if spool is not None:
+            out.close()
+            try:
+                os.remove(spool)
+            except OSError:
+                pass
+
+
+class ChunkTable:
+    """
+    Columnar chunk metadata: one array per field, indexed by chunk position.
+    File paths and tags are interned; tags belong to files, not chunks.
+    The filter index used by select() is derived on first use and not persisted.
+    """
+    __slots__ = ("paths", "path_ids", "tag_names", "tag_ids", "file_tags",
+                 "file", "chunk_id", "start", "end", "mtime", "src_start", "src_end", "_filters")
+
+    def __init__(self):
+        self.paths = []          # file id -> path
+        self.path_ids = {}       # path -> file id
+        self.tag_names = []      # tag id -> tag
+        self.tag_ids = {}        # tag -> tag id
+        self.file_tags = []      # file id -> tuple of tag ids
+        self.file = array('i')   # chunk -> file id
+        self.chunk_id = array('i')
+        self.start = array('q')  # chunk -> byte range in the index's TextStore
+        self.end = array('q')
+        self.mtime = array('d')
+        self.src_start = array('q')  # chunk -> byte range in its source file (-1 when unknown)
+        self.src_end = array('q')
+
+    def __len__(self):
+        return len(self.file)
+
+    def add_file(self, path: str, tags) -> int:
+        """Intern a file path (and its tags) and return its file id."""
+        fid = self.path_ids.get(path)
+        if fid is None:
+            fid = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.file_tags.append(tuple(self.tag_ids.setdefault(t, len(self.tag_ids)) for t in tags))
+            if len(self.tag_ids) > len(self.tag_names):
+                self.tag_names = sorted(self.tag_ids, key=self.tag_ids.get)
+        return fid
+
+    def append(self, fid: int, chunk_id: int, start: int, end: int, mtime: float, src_start: int = -1, src_end: int = -1):
+        self.file.append(fid)
+        self.chunk_id.append(chunk_id)
+        self.start.append(start)
+        self.end.append(end)
+        self.mtime.append(mtime or 0.0)
+        self.src_start.append(src_start)
+        self.src_end.append(src_end)
+
+    def path(self, idx: int) -> str:
+        return self.paths[self.file[idx]]
+
+    def tags(self, idx: int):
+        return [self.tag_names[t] for t in self.file_tags[self.file[idx]]]
+
+    def filter_index(self):
+        """
+        Chunk ids grouped by file (file_ptr/by_file, CSR-style), chunk ids in mtime order
+        (by_mtime/sorted_mtime, for bisecting ranges) and tag id -> sorted chunk ids.
+        """
+        index = getattr(self, "_filters", None)
+        if index is not None:
+            return index
+        n_files = len(self.paths)
+        if np is not None:
+            file = np.frombuffer(self.file, dtype=np.intc)
+            mtime = np.frombuffer(self.mtime, dtype=np.float64)
+            by_file = np.argsort(file, kind="stable")
+            file_ptr = np.concatenate([[0], np.cumsum(np.bincount(file, minlength=n_files))])
+            by_mtime = np.argsort(mtime, kind="stable")
+            sorted_mtime = mtime[by_mtime]
+        else:
+            by_file = sorted(range(len(self)), key=self.file.__getitem__)
+            counts = [0] * n_files
+            for fid in self.file:
+                counts[fid] += 1
+            file_ptr = [0]
+            for count in counts:
+                file_ptr.append(file_ptr[-1] + count)
+            by_mtime = sorted(range(len(self)), key=self.mtime.__getitem__)
+            sorted_mtime = [self.mtime[idx] for idx in by_mtime]
+        tag_files = {}
+        for fid, tids in enumerate(self.file_tags):
+            for tid in tids:
+                tag_files.setdefault(tid, []).append(fid)
+        tag_chunks = {tid: self._file_chunks(fids, by_file, file_ptr) for tid, fids in tag_files.items()}
+        index = self._filters = {
+            "by_file": by_file, "file_ptr": file_ptr,
+            "by_mtime": by_mtime, "sorted_mtime": sorted_mtime, "tag_chunks": tag_chunks,
+        }
+        return index
+
+    @staticmethod
+    def _file_chunks(fids, by_file, file_ptr):
+        """Sorted chunk ids of the given files."""
+        if np is not None:
+            parts = [by_file[file_ptr[fid]:file_ptr[fid + 1]] for fid in fids]
+            return np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+        return sorted(idx for fid in fids for idx in by_file[file_ptr[fid]:file_ptr[fid + 1]])
+
+    def select(self, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None, aliases=None):
+        """
+        Sorted ids (an int64 array with NumPy) of the chunks passing the search filters
+        (lowercased path_contains/tag), or None when no filter is set. aliases maps file
+        ids to other paths with the same content, which path_contains also matches.
+        How many chunks each filter matches is read off the filter index; only the most
+        selective filter's chunks are listed, and the other filters are checked on those
+        alone. Chunks without an mtime pass the mtime filters.
+        """
+        timed = min_mtime is not None or max_mtime is not None
+        if not (path_contains or tag or timed):
+            return None
+        index = self.filter_index()
+        file_ptr = index["file_ptr"]
+        options = []  # (matching chunks, kind, detail)
+        if path_contains:
+            aliases = aliases or {}
+            path_files = [fid for fid, p in enumerate(self.paths) if path_contains in p.lower()
+                          or any(path_contains in a.lower() for a in aliases.get(fid, ()))]
+            options.append((sum(file_ptr[fid + 1] - file_ptr[fid] for fid in path_files), "path", path_files))
+        if tag:
+            tid = self.tag_ids.get(tag)
+            tagged = index["tag_chunks"].get(tid, [])
+            options.append((len(tagged), "tag", tagged))
+        if timed:
+            sorted_mtime = index["sorted_mtime"]
+            lo = 0 if min_mtime is None else bisect.bisect_left(sorted_mtime, min_mtime)
+            hi = len(sorted_mtime) if max_mtime is None else bisect.bisect_right(sorted_mtime, max_mtime)
+            z_lo, z_hi = bisect.bisect_left(sorted_mtime, 0.0), bisect.bisect_right(sorted_mtime, 0.0)
+            spans = [(lo, max(lo, hi))] + ([(z_lo, z_hi)] if z_hi > z_lo and not lo <= z_lo < z_hi <= hi else [])
+            options.append((sum(b - a for a, b in spans), "mtime", spans))
+        options.sort(key=lambda option: option[0])
+
+        _, kind, detail = options[0]
+        if kind == "path":
+            ids = self._file_chunks(detail, index["by_file"], file_ptr)
+        elif kind == "tag":
+            ids = detail
+        elif np is not None:
+            ids = np.unique(np.concatenate([index["by_mtime"][a:b] for a, b in detail]))
+        else:
+            ids = sorted({idx for a, b in detail for idx in index["by_mtime"][a:b]})
+
+        for _, kind, detail in options[1:]:
+            if kind == "path":
+                file_ok = [False] * len(self.paths)
+                for fid in detail:
+                    file_ok[fid] = True
+            elif kind == "tag":
+                tid = self.tag_ids.get(tag)
+                file_ok = [tid in tids for tids in self.file_tags]
+            if np is not None:
+                ids = np.asarray(ids, dtype=np.int64)
+                if kind == "mtime":
+                    mtime = np.frombuffer(self.mtime, dtype=np.float64)[ids]
+                    keep = mtime == 0
+                    if min_mtime is not None and max_mtime is not None:
+                        keep |= (mtime >= min_mtime) & (mtime <= max_mtime)
+                    elif min_mtime is not None:
+                        keep |= mtime >= min_mtime
+                    else:
+                        keep |= mtime <= max_mtime
+                else:
+                    keep = np.asarray(file_ok, dtype=bool)[np.frombuffer(self.file, dtype=np.intc)[ids]]
+                ids = ids[keep]
+            elif kind == "mtime":
+                mtime = self.mtime
+                ids = [idx for idx in ids if not mtime[idx] or (
+                    (min_mtime is None or mtime[idx] >= min_mtime) and (max_mtime is None or mtime[idx] <= max_mtime))]
+            else:
+                ids = [idx for idx in ids if file_ok[self.file[idx]]]
+        return np.asarray(ids, dtype=np.int64) if np is not None else ids
+
+    def to_state(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ("path_ids", "tag_ids", "_filters")}
+
+    @classmethod
+    def from_state(cls, state):
+        table = cls.__new__(cls)
+        for name, value in state.items():
+            setattr(table, name, value)
+        if "src_start" not in state:
+            # Segments before format 5 did not record source byte ranges.
+            table.src_start = array('q', [-1]) * len(table.file)
+            table.src_end = array('q', [-1]) * len(table.file)
+        table.path_ids = {p: fid for fid, p in enumerate(table.paths)}
+        table.tag_ids = {t: tid for tid, t in enumerate(table.tag_names)}
+        return table
+
+    @classmethod
+    def from_dicts(cls, entries):
+        """Build a table from format-2 chunk dicts (file/chunk_id/start/end/mtime/tags)."""
+        table = cls()
+        for entry in entries:
+            fid = table.add_file(entry.get("file"), entry.get("tags") or [])
+            table.append(fid, entry.get("chunk_id") or 1, entry["start"], entry["end"], entry.get("mtime"))
+        return table
+
+
+class RagIndex:
+    """
+    A named chunk index plus a term -> postings inverted index, stored CSR-style:
+    term id t owns postings post_ptr[t]:post_ptr[t+1], and posting j lists chunk
+    post_chunks[j], its term frequency post_tf[j] and token positions
+    positions[pos_ptr[j]:pos_ptr[j+1]]. doc_len holds each chunk's token count.
+
+    Chunk metadata is a columnar ChunkTable; chunk text lives in a memory-mapped
+    TextStore, addressed by each chunk's (start, end) byte range. files maps each indexed
+    path to its mtime/size/sha1, its byte range in the store and its chunk range,
+    so create_index can refresh the index incrementally.
+
+    fragments are (chunk ids, analyze_texts result) pairs for the chunks that were
+    (re-)analyzed; when omitted every chunk is analyzed here. When rebuilding from a
+    previous index, reused[i] names the previous chunk that chunk i was carried
+    over from (-1 for fresh chunks).
+
+    minhash holds each chunk's MinHash signature (MINHASH_SIZE uint32 values,
+    flattened; None when built without NumPy). hidden holds the sorted ids of chunks
+    collapsed as near-duplicates, which searches skip (None when not collapsing).
+
+    An index is never modified once built (apart from caches built on first use);
+    a rebuild produces a new generation, numbered by save_index.
+    """
+    def __init__(self, chunks, store, fragments=None, files=None, directory=None, previous=None, reused=None):
+        self.chunks = chunks
+        self.store = store
+        self.files = files
+        self.directory = directory
+        self.generation = 0
+        if fragments is None:
+            fragments = [(range(len(chunks)), analyze_texts([self.text(idx) for idx in range(len(chunks))]))]
+            previous = None
+        elif previous is not None and np is None:
+            # Without NumPy, carried-over chunks are simply re-analyzed.
+            carried = [idx for idx, old in enumerate(reused) if old >= 0]
+            fragments = fragments + [(carried, analyze_texts([self.text(idx) for idx in carried]))]
+            previous = None
+
+        self.doc_len = array('i', bytes(4 * len(chunks)))
+        for ids, fragment in fragments:
+            for local, length in enumerate(fragment["doc_len"]):
+                self.doc_len[ids[local]] = length
+        if previous is not None:
+            for idx, old in enumerate(reused):
+                if old >= 0:
+                    self.doc_len[idx] = previous.doc_len[old]
+        self.avg_len = (sum(self.doc_len) / len(chunks)) if chunks else 0.0
+
+        if np is None:
+            self._pack(fragments)
+            self.minhash = None
+        else:
+            self._merge(fragments, previous, reused)
+            self.minhash = self._merge_minhash(fragments, previous, reused)
+        self.hidden = None
+
+    @classmethod
+    def from_legacy(cls, raw):
+        """Upgrade an older index (chunk list with inline text, or path->content dict)."""
+        if isinstance(raw, dict):
+            raw = [{"file": fp, "chunk_id": 1, "text": content, "mtime": 0, "tags": []} for fp, content in raw.items()]
+        writer = TextStoreWriter()
+        chunks = ChunkTable()
+        for entry in raw:
+            data = (entry.get("text") or "").encode('utf-8')
+            start = writer.append(data)
+            fid = chunks.add_file(entry.get("file"), entry.get("tags") or [])
+            chunks.append(fid, entry.get("chunk_id") or 1, start, start + len(data), entry.get("mtime"))
+        return cls(chunks, writer.close())
+
+    def text(self, idx: int) -> str:
+        """Materialize the text of one chunk from the store."""
+        return self.store.text(self.chunks.start[idx], self.chunks.end[idx])
+
+    def to_segment(self):
+        """Plain, versioned state for the on-disk segment; the text store is saved alongside."""
+        state = {k: v for k, v in self.__dict__.items() if k not in ("store", "generation") and not k.startswith("_")}
+        state["chunks"] = self.chunks.to_state()
+        return {"format": SEGMENT_FORMAT, **state}
+
+    @classmethod
+    def from_segment(cls, state, store=None):
+        """
+        Rebuild an index from a segment written by to_segment and its text store.
+        Older formats are upgraded on load: 1 had inline chunk text and no store,
+        2 had per-chunk dicts instead of a ChunkTable, 3 had no trigram index, 4 had
+        no source byte ranges (they stay unknown until the file is re-chunked), 5 had
+        no MinHash signatures (computed from the postings on first use), and up to 6
+        trigrams of text with U+0130 were folded differently (their trigram index is
+        rebuilt on load).
+        """
+        fmt = state.get("format")
+        if fmt == 1:
+            index = cls.from_legacy(state["chunks"])
+            index.directory = state.get("directory")
+            return index
+        if fmt not in (2, 3, 4, 5, 6, SEGMENT_FORMAT):
+            raise ValueError(f"Unsupported segment format {fmt!r}.")
+        index = cls.__new__(cls)
+        index.__dict__.update({k: v for k, v in state.items() if k != "format"})
+        if fmt == 2:
+            index.chunks = ChunkTable.from_dicts(state["chunks"])
+        else:
+            index.chunks = ChunkTable.from_state(state["chunks"])
+        index.store = store
+        if fmt < 4:
+            return cls(index.chunks, store, files=index.files, directory=index.directory)
+        if fmt < 6:
+            index.minhash = None
+            index.hidden = None
+        if fmt < 7 and store is not None and store.contains("\u0130".encode('utf-8')):
+            index.rebuild_trigrams()
+        return index
+
+    def rebuild_trigrams(self):
+        """Recompute the trigram index from the chunk texts."""
+        tri = {}
+        for idx in range(len(self.chunks)):
+            for code in trigram_codes(self.text(idx)):
+                tri.setdefault(int(code), []).append(idx)
+        self.tri_keys = array('i', sorted(tri))
+        self.tri_ptr = array('q', [0])
+        self.tri_chunks = array('i')
+        for code in self.tri_keys:
+            self.tri_chunks.extend(tri[code])
+            self.tri_ptr.append(len(self.tri_chunks))
+
+    def _pack(self, fragments):
+        """Lay out the postings and trigrams of (chunk ids, fragment) pairs as the CSR arrays."""
+        building = {}
+        tri = {}
+        for ids, fragment in fragments:
+            terms = fragment["terms"]
+            positions = fragment["positions"]
+            at = 0
+            for tid, local, tf in zip(fragment["post_term"], fragment["post_chunk"], fragment["post_tf"]):
+                building.setdefault(terms[tid], {})[ids[local]] = positions[at:at + tf]
+                at += tf
+            for code, local in zip(fragment["tri_keys"], fragment["tri_chunk"]):
+                tri.setdefault(code, []).append(ids[local])
+
+        self.terms = sorted(building)
+        self.vocab = {term: tid for tid, term in enumerate(self.terms)}
+        self.post_ptr = array('q', [0])
+        self.post_chunks = array('i')
+        self.post_tf = array('i')
+        self.pos_ptr = array('q', [0])
+        self.positions = array('i')
+        for term in self.terms:
+            for idx, plist in sorted(building[term].items()):
+                self.post_chunks.append(idx)
+                self.post_tf.append(len(plist))
+                self.positions.extend(plist)
+                self.pos_ptr.append(len(self.positions))
+            self.post_ptr.append(len(self.post_chunks))
+
+        self.tri_keys = array('i', sorted(tri))
+        self.tri_ptr = array('q', [0])
+        self.tri_chunks = array('i')
+        for code in self.tri_keys:
+            self.tri_chunks.extend(sorted(tri[code]))
+            self.tri_ptr.append(len(self.tri_chunks))
+
+    def _merge(self, fragments, previous=None, reused=None):
+        """
+        NumPy version of _pack. When rebuilding from previous, the postings and trigrams
+        of reused chunks are carried over (renumbered to their new chunk positions)
+        instead of being re-analyzed.
+        """
+        tids, post_chunks, post_tf, positions = [], [], [], []
+        tri_keys, tri_owners = [], []
+        terms = set()
+        for _, fragment in fragments:
+            terms.update(fragment["terms"])
+
+        if previous is not None:
+            reused = np.asarray(reused, dtype=np.int64)
+            old_to_new = np.full(len(previous.chunks), -1, dtype=np.int64)
+            carried = np.nonzero(reused >= 0)[0]
+            old_to_new[reused[carried]] = carried
+
+            old_ptr = np.frombuffer(previous.post_ptr, dtype=np.int64)
+            old_tf = np.frombuffer(previous.post_tf, dtype=np.intc)
+            old_chunks = old_to_new[np.frombuffer(previous.post_chunks, dtype=np.intc)]
+            keep = old_chunks >= 0
+            old_tids = np.repeat(np.arange(len(previous.terms)), np.diff(old_ptr))[keep]
+            kept_tids = np.unique(old_tids)
+            terms.update(previous.terms[t] for t in kept_tids.tolist())
+            post_chunks.append(old_chunks[keep])
+            post_tf.append(old_tf[keep])
+            positions.append(np.frombuffer(previous.positions, dtype=np.intc)[np.repeat(keep, old_tf)])
+
+            old_tri_ptr = np.frombuffer(previous.tri_ptr, dtype=np.int64)
+            old_owners = old_to_new[np.frombuffer(previous.tri_chunks, dtype=np.intc)]
+            keep_tri = old_owners >= 0
+            tri_keys.append(np.repeat(np.frombuffer(previous.tri_keys, dtype=np.intc), np.diff(old_tri_ptr))[keep_tri])
+            tri_owners.append(old_owners[keep_tri])
+
+        self.terms = sorted(terms)
+        self.vocab = {term: tid for tid, term in enumerate(self.terms)}
+        if previous is not None:
+            remap = np.zeros(len(previous.terms), dtype=np.int64)
+            remap[kept_tids] = [self.vocab[previous.terms[t]] for t in kept_tids.tolist()]
+            tids.append(remap[old_tids])
+
+        for ids, fragment in fragments:
+            ids = np.asarray(ids, dtype=np.int64)
+            lookup = np.asarray([self.vocab[t] for t in fragment["terms"]], dtype=np.int64)
+            tids.append(lookup[np.frombuffer(fragment["post_term"], dtype=np.intc)])
+            post_chunks.append(ids[np.frombuffer(fragment["post_chunk"], dtype=np.intc)])
+            post_tf.append(np.frombuffer(fragment["post_tf"], dtype=np.intc))
+            positions.append(np.frombuffer(fragment["positions"], dtype=np.intc))
+            tri_keys.append(np.frombuffer(fragment["tri_keys"], dtype=np.intc))
+            tri_owners.append(ids[np.frombuffer(fragment["tri_chunk"], dtype=np.intc)])
+
+        empty = np.zeros(0, dtype=np.int64)
+        tids = np.concatenate(tids) if tids else empty
+        post_chunks = np.concatenate(post_chunks) if post_chunks else empty
+        post_tf = np.concatenate(post_tf).astype(np.int64) if post_tf else empty
+        positions = np.concatenate(positions) if positions else empty
+
+        # Sort postings by (term, chunk) and gather each posting's positions run to match.
+        # The pairs are unique, so one sort on a combined key replaces a slower lexsort.
+        order = np.argsort((tids << 32) | post_chunks)
+        starts = (np.cumsum(post_tf) - post_tf)[order]
+        lens = post_tf[order]
+        gather = np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(int(lens.sum()))
+
+        self.post_ptr = _to_array('q', np.concatenate([[0], np.cumsum(np.bincount(tids, minlength=len(self.terms)))]))
+        self.post_chunks = _to_array('i', post_chunks[order])
+        self.post_tf = _to_array('i', lens)
+        self.pos_ptr = _to_array('q', np.concatenate([[0], np.cumsum(lens)]))
+        self.positions = _to_array('i', positions[gather])
+
+        tri_keys = np.concatenate(tri_keys) if tri_keys else empty
+        tri_owners = np.concatenate(tri_owners) if tri_owners else empty
+        pairs = np.sort((tri_keys.astype(np.int64) << 32) | tri_owners)
+        tri_keys, tri_owners = pairs >> 32, pairs & 0xFFFFFFFF
+        firsts = np.flatnonzero(np.concatenate([[True], tri_keys[1:] != tri_keys[:-1]])) if len(pairs) else empty
+        self.tri_keys = _to_array('i', tri_keys[firsts])
+        self.tri_ptr = _to_array('q', np.append(firsts, len(pairs)))
+        self.tri_chunks = _to_array('i', tri_owners)
+
+    def _merge_minhash(self, fragments, previous=None, reused=None):
+        """MinHash signatures of every chunk: from the fragments, or carried over from previous."""
+        if any("minhash" not in fragment for _, fragment in fragments):
+            return None
+        signatures = np.full((len(self.chunks), MINHASH_SIZE), 0xFFFFFFFF, dtype=np.uint32)
+        for ids, fragment in fragments:
+            rows = np.frombuffer(fragment["minhash"], dtype=np.uint32).reshape(-1, MINHASH_SIZE)
+            signatures[np.asarray(ids, dtype=np.int64)] = rows
+        if previous is not None:
+            reused = np.asarray(reused, dtype=np.int64)
+            carried = np.nonzero(reused >= 0)[0]
+            signatures[carried] = previous.signatures()[reused[carried]]
+        return array('I', signatures.tobytes())
+
+    def signatures(self):
+        """MinHash signatures as a (chunks x MINHASH_SIZE) uint32 matrix."""
+        if self.minhash is not None:
+            return np.frombuffer(self.minhash, dtype=np.uint32).reshape(-1, MINHASH_SIZE)
+        signatures = getattr(self, "_signatures", None)
+        if signatures is None:
+            # Indexes saved without signatures get them from the postings, once.
+            post_ptr = np.frombuffer(self.post_ptr, dtype=np.int64)
+            tids = np.repeat(np.arange(len(self.terms)), np.diff(post_ptr))
+            signatures = self._signatures = minhash_signatures(
+                self.terms, tids, np.frombuffer(self.post_chunks, dtype=np.intc), len(self.chunks))
+        return signatures
+
+    def band_keys(self):
+        """LSH keys: one uint64 per chunk and band, hashed from that band of the signature."""
+        keys = getattr(self, "_bands", None)
+        if keys is None:
+            bands = self.signatures().reshape(len(self.chunks), MINHASH_BANDS, MINHASH_SIZE // MINHASH_BANDS).astype(np.uint64)
+            keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+            for row in range(bands.shape[2]):
+                keys = mix_hash(keys ^ bands[:, :, row])
+            self._bands = keys
+        return keys
+
+    def duplicate_clusters(self, threshold: float = DUPLICATE_THRESHOLD):
+        """
+        Groups of near-duplicate chunks as sorted chunk id lists, largest first. Chunks
+        sharing an LSH band key are candidates; each is compared with the lowest chunk id
+        in its bucket and joined to it when their signatures agree on >= threshold.
+        """
+        n = len(self.chunks)
+        ids = np.flatnonzero(np.frombuffer(self.doc_len, dtype=np.intc) > 0)
+        if len(ids) < 2:
+            return []
+        signatures = self.signatures()
+        keys = self.band_keys()
+        parent = list(range(n))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(MINHASH_BANDS):
+            check_cancelled()
+            order = ids[np.argsort(keys[ids, band], kind="stable")]
+            sorted_keys = keys[order, band]
+            new_group = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+            leaders = order[np.flatnonzero(new_group)[np.cumsum(new_group) - 1]]
+            pairs = leaders != order
+            leaders, members = leaders[pairs], order[pairs]
+            if not len(members):
+                continue
+            similar = (signatures[leaders] == signatures[members]).mean(axis=1) >= threshold
+            for a, b in zip(leaders[similar].tolist(), members[similar].tolist()):
+                ra, rb = find(a), find(b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+
+        groups = {}
+        for idx in range(n):
+            root = find(idx)
+            if root != idx:
+                groups.setdefault(root, [root]).append(idx)
+        return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+
+    def collapse_duplicates(self, threshold: float = DUPLICATE_THRESHOLD) -> int:
+        """Hide all but the first chunk of each near-duplicate cluster; returns how many were hidden."""
+        hidden = sorted(idx for group in self.duplicate_clusters(threshold) for idx in group[1:])
+        self.hidden = array('i', hidden)
+        return len(hidden)
+
+    def aliases(self):
+        """File id -> paths of other files with the same content, which are stored once."""
+        table = getattr(self, "_aliases", None)
+        if table is None:
+            table = {}
+            for path, entry in (self.files or {}).items():
+                fid = self.chunks.path_ids.get(entry.get("alias"))
+                if fid is not None:
+                    table.setdefault(fid, []).append(path)
+            self._aliases = table
+        return table
+
+    def select(self, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None):
+        """
+        ChunkTable.select, with path_contains also matching the aliases of a file, and
+        leaving out chunks collapsed as near-duplicates.
+        """
+        allowed = self.chunks.select(path_contains, tag, min_mtime, max_mtime, self.aliases())
+        if not self.hidden:
+            return allowed
+        if np is not None:
+            visible = np.ones(len(self.chunks), dtype=bool)
+            visible[np.frombuffer(self.hidden, dtype=np.intc)] = False
+            return np.flatnonzero(visible) if allowed is None else allowed[visible[allowed]]
+        hidden = set(self.hidden)
+        ids = range(len(self.chunks)) if allowed is None else allowed
+        return [idx for idx in ids if idx not in hidden]
+
+    def trigram_chunks(self, literal: str):
+        """
+        Chunks containing every trigram of a literal (fold_case applied), or None
+        when the literal is too short to constrain anything.
+        """
+        codes = trigrams(literal)
+        if not codes:
+            return None
+        result = None
+        for code in sorted(codes, key=lambda c: self._trigram_count(c)):
+            k = bisect.bisect_left(self.tri_keys, code)
+            if k == len(self.tri_keys) or self.tri_keys[k] != code:
+                return set()
+            found = self.tri_chunks[self.tri_ptr[k]:self.tri_ptr[k + 1]]
+            result = set(found) if result is None else result.intersection(found)
+            if not result:
+                return result
+        return result
+
+    def _trigram_count(self, code: int) -> int:
+        k = bisect.bisect_left(self.tri_keys, code)
+        if k == len(self.tri_keys) or self.tri_keys[k] != code:
+            return 0
+        return self.tri_ptr[k + 1] - self.tri_ptr[k]
+
+    def regex_candidates(self, required):
+        """
+        Chunks that can match a regex, from the AND-list produced by regex_literals.
+        Returns None when the pattern yields no usable trigrams.
+        """
+        result = None
+        for item in required:
+            if isinstance(item, tuple):
+                found = set()
+                for alternative in item[1]:
+                    alt = self.regex_candidates(alternative)
+                    if alt is None:
+                        found = None
+                        break
+                    found |= alt
+            else:
+                found = self.trigram_chunks(item)
+            if found is None:
+                continue
+            result = found if result is None else result & found
+            if not result:
+                break
+        return result
+
+    def fuzzy_terms(self, token: str, threshold: float):
+        """
+        Vocabulary terms similar to a query word: within (1 - threshold) * len(token) / 2
+        edits, at most FUZZY_MAX_EDITS, and with 1 - distance / longer length >= threshold.
+        The old sliding-window matcher scored a query against its words plus two more, so
+        a typo was diluted by the neighbouring words; halving the edit budget keeps the
+        default 0.6 about as selective (exact under 5 characters, one edit under 10).
+        """
+        edits = min(FUZZY_MAX_EDITS, int((1 - threshold) * len(token) / 2 + 1e-9))
+        if edits <= 0:
+            return [token] if token in self.vocab else []
+        keys, tids = self.deletion_table()
+        candidates = set()
+        for key in map(deletion_key, deletes(token[:FUZZY_PREFIX], edits)):
+            lo = bisect.bisect_left(keys, key)
+            candidates.update(tids[lo:bisect.bisect_right(keys, key, lo)].tolist())
+        matches = []
+        for tid in sorted(candidates):
+            term = self.terms[tid]
+            distance = edit_distance(token, term, edits)
+            if distance <= edits and 1 - distance / max(len(token), len(term)) >= threshold:
+                matches.append(term)
+        return matches
+
+    def deletion_table(self):
+        """
+        deletion_table(self.terms), built once on the first fuzzy query (under index_lock,
+        so concurrent queries share it) and kept only in memory.
+        """
+        table = getattr(self, "_deletes", None)
+        if table is None:
+            with index_lock:
+                table = getattr(self, "_deletes", None)
+                if table is None:
+                    table = self._deletes = deletion_table(self.terms)
+        return table
+
+    def fuzzy_candidates(self, q_lower: str, threshold: float):
+        """
+        Chunks where every query word has a fuzzy match, with the matches no further
+        apart than the query length plus two words.
+        """
+        tokens = WORD_RE.findall(q_lower)
+        if not tokens:
+            return []
+        per_token = []
+        for token in tokens:
+            positions = {}
+            for term in self.fuzzy_terms(token, threshold):
+                for idx, plist in self.postings(term):
+                    positions.setdefault(idx, []).extend(plist)
+            if not positions:
+                return []
+            per_token.append(positions)
+        common = set(min(per_token, key=len))
+        for positions in per_token:
+            common.intersection_update(positions)
+        if len(tokens) == 1:
+            return sorted(common)
+        window = len(tokens) + 2
+        return sorted(idx for idx in common if within_window([p[idx] for p in per_token], window))
+
+    def postings(self, term: str):
+        """Yield (chunk position, token positions) for every chunk containing term."""
+        tid = self.vocab.get(term)
+        if tid is None:
+            return
+        for j in range(self.post_ptr[tid], self.post_ptr[tid + 1]):
+            yield self.post_chunks[j], self.positions[self.pos_ptr[j]:self.pos_ptr[j + 1]]
+
+    def term_positions(self, term: str, idx: int):
+        """Token positions of term in chunk idx (empty when it does not occur there)."""
+        tid = self.vocab.get(term)
+        if tid is None:
+            return []
+        lo, hi = self.post_ptr[tid], self.post_ptr[tid + 1]
+        j = bisect.bisect_left(self.post_chunks, idx, lo, hi)
+        if j == hi or self.post_chunks[j] != idx:
+            return []
+        return self.positions[self.pos_ptr[j]:self.pos_ptr[j + 1]]
+
+    def document_frequency(self, term: str) -> int:
+        """Number of chunks containing term."""
+        tid = self.vocab.get(term)
+        return 0 if tid is None else self.post_ptr[tid + 1] - self.post_ptr[tid]
+
+    def term_chunks(self, term: str, within=None):
+        """
+        Set of chunks containing term, restricted to the chunk set within (None = all).
+        When within is much smaller than the posting list, its chunks are looked up in
+        the postings by bisection instead of reading the whole list.
+        """
+        tid = self.vocab.get(term)
+        if tid is None:
+            return set()
+        lo, hi = self.post_ptr[tid], self.post_ptr[tid + 1]
+        if within is None:
+            return set(self.post_chunks[lo:hi])
+        if 8 * len(within) < hi - lo:
+            found = set()
+            for idx in within:
+                j = bisect.bisect_left(self.post_chunks, idx, lo, hi)
+                if j < hi and self.post_chunks[j] == idx:
+                    found.add(idx)
+            return found
+        return within.intersection(self.post_chunks[lo:hi])
+
+    def phrase_chunks(self, tokens, within=None):
+        """
+        Set of chunks (restricted to within, None = all) where tokens occur at consecutive
+        token positions. The rarest token narrows first; positions are checked last.
+        """
+        found = within
+        for term in sorted(set(tokens), key=self.document_frequency):
+            found = self.term_chunks(term, found)
+            if not found:
+                return set()
+        if len(tokens) == 1:
+            return found
+        matches = set()
+        for idx in found:
+            following = [set(self.term_positions(term, idx)) for term in tokens[1:]]
+            if any(all(p + k in following[k - 1] for k in range(1, len(tokens)))
+                   for p in self.term_positions(tokens[0], idx)):
+                matches.add(idx)
+        return matches
+
+    def match_spans(self, idx: int, text: str, terms=(), pattern=None):
+        """
+        Character spans of a hit's matches in chunk idx's text: pattern matches when given,
+        otherwise the recorded positions of the given vocabulary terms.
+        """
+        if pattern is not None:
+            return [m.span() for m in pattern.finditer(text) if m.end() > m.start()]
+        positions = [pos for term in dict.fromkeys(terms) for pos in self.term_positions(term, idx)]
+        return token_spans(text, positions)
+
+    def _matching_terms(self, token: str, open_left: bool, open_right: bool):
+        """
+        Vocabulary terms a query token can land on. A token touching the start (end)
+        of the query may be the tail (head) of a longer word in the chunk.
+        """
+        if not open_left and not open_right:
+            return [token] if token in self.vocab else []
+        if open_left and open_right:
+            return [t for t in self.terms if token in t]
+        if open_left:
+            return [t for t in self.terms if t.endswith(token)]
+        lo = bisect.bisect_left(self.terms, token)
+        hi = lo
+        while hi < len(self.terms) and self.terms[hi].startswith(token):
+            hi += 1
+        return self.terms[lo:hi]
+
+    def candidates(self, q_lower: str):
+        """
+        Chunk positions that may contain q_lower as a substring, found by intersecting
+        postings and checking that the query's words sit at consecutive positions.
+        Returns None when the query has no word characters and cannot be narrowed.
+        """
+        tokens = list(WORD_RE.finditer(q_lower))
+        if not tokens:
+            return None
+        last = len(tokens) - 1
+        if last == 0:
+            # A single word needs no positions: every chunk holding a matching term qualifies.
+            found = set()
+            for term in self._matching_terms(tokens[0].group(), tokens[0].start() == 0, tokens[0].end() == len(q_lower)):
+                tid = self.vocab[term]
+                found.update(self.post_chunks[self.post_ptr[tid]:self.post_ptr[tid + 1]])
+            return sorted(found)
+        per_token = []
+        for k, m in enumerate(tokens):
+            open_left = k == 0 and m.start() == 0
+            open_right = k == last and m.end() == len(q_lower)
+            positions = {}
+            for term in self._matching_terms(m.group(), open_left, open_right):
+                for idx, plist in self.postings(term):
+                    positions.setdefault(idx, set()).update(plist)
+            if not positions:
+                return []
+            per_token.append(positions)
+
+        common = set(min(per_token, key=len))
+        for positions in per_token:
+            common.intersection_update(positions)
+        if last == 0:
+            return sorted(common)
+        matches = []
+        for idx in common:
+            if any(all(p + k in per_token[k][idx] for k in range(1, last + 1)) for p in per_token[0][idx]):
+                matches.append(idx)
+        return sorted(matches)
+
+    def bm25(self, terms):
+        """
+        Score every chunk containing at least one of terms with Okapi BM25.
+        Returns parallel sequences (chunk positions, scores).
+        """
+        tids = sorted({self.vocab[t] for t in terms if t in self.vocab})
+        n = len(self.chunks)
+        if not tids or not n:
+            return [], []
+        if np is not None:
+            post_chunks = np.frombuffer(self.post_chunks, dtype=np.intc)
+            post_tf = np.frombuffer(self.post_tf, dtype=np.intc)
+            doc_len = np.frombuffer(self.doc_len, dtype=np.intc)
+            spans = [(self.post_ptr[t], self.post_ptr[t + 1]) for t in tids]
+            docs = np.concatenate([post_chunks[lo:hi] for lo, hi in spans])
+            tf = np.concatenate([post_tf[lo:hi] for lo, hi in spans]).astype(np.float64)
+            df = np.array([hi - lo for lo, hi in spans], dtype=np.float64)
+            idf = np.repeat(np.log1p((n - df + 0.5) / (df + 0.5)), [hi - lo for lo, hi in spans])
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[docs] / (self.avg_len or 1.0))
+            partial = idf * tf * (BM25_K1 + 1) / (tf + norm)
+            uniq, inverse = np.unique(docs, return_inverse=True)
+            return uniq, np.bincount(inverse, weights=partial)
+
+        totals = {}
+        for tid in tids:
+            lo, hi = self.post_ptr[tid], self.post_ptr[tid + 1]
+            idf = math.log1p((n - (hi - lo) + 0.5) / ((hi - lo) + 0.5))
+            for j in range(lo, hi):
+                idx, tf = self.post_chunks[j], self.post_tf[j]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[idx] / (self.avg_len or 1.0))
+                totals[idx] = totals.get(idx, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return list(totals.keys()), list(totals.values())
+
+    def idf(self, df):
+        """Smoothed TF-IDF inverse document frequency for document frequencies df."""
+        return np.log((1 + len(self.chunks)) / (1 + np.asarray(df, dtype=np.float64))) + 1
+
+    def vectors(self):
+        """
+        Chunk vectors for vector search: a float32 matrix with one L2-normalized hashed
+        TF-IDF row per chunk (see embed). Built from the postings on first use, a batch
+        of chunks at a time, and kept only in memory.
+        """
+        matrix = getattr(self, "_vectors", None)
+        if matrix is not None:
+            return matrix
+        n = len(self.chunks)
+        matrix = np.zeros((n, VECTOR_DIM), dtype=np.float32)
+        post_ptr = np.frombuffer(self.post_ptr, dtype=np.int64)
+        df = np.diff(post_ptr)
+        tids = np.repeat(np.arange(len(self.terms)), df)
+        post_chunks = np.frombuffer(self.post_chunks, dtype=np.intc)
+        weights = (1 + np.log(np.frombuffer(self.post_tf, dtype=np.intc))) * self.idf(df)[tids]
+        by_chunk = np.argsort(post_chunks, kind="stable")
+        chunk_ptr = np.concatenate([[0], np.cumsum(np.bincount(post_chunks, minlength=n))])
+        table = feature_table(self.terms)
+        # Bound each batch's dense buffer and its expanded postings.
+        batch_rows = max(1, (1 << 22) // vector_space())
+        lo = 0
+        while lo < n:
+            check_cancelled()
+            hi = min(n, lo + batch_rows, max(lo + 1, int(np.searchsorted(chunk_ptr, chunk_ptr[lo] + (1 << 18), "right")) - 1))
+            batch = by_chunk[chunk_ptr[lo]:chunk_ptr[hi]]
+            rows = post_chunks[batch].astype(np.int64) - lo
+            matrix[lo:hi] = embed(rows, hi - lo, tids[batch], weights[batch], table)
+            lo = hi
+        self._vectors = matrix
+        return matrix
+
+    def cache_bytes(self) -> int:
+        """
+        Bytes held by the caches built on first use: chunk vectors, signatures, LSH keys
+        and the fuzzy deletion table.
+        """
+        caches = [getattr(self, name, None) for name in ("_vectors", "_signatures", "_bands")]
+        caches += getattr(self, "_deletes", None) or ()
+        return sum(memoryview(cache).nbytes for cache in caches if cache is not None)
+
+    def query_vector(self, q_lower: str):
+        """The query's vector in the space of vectors(), or None when it has no words."""
+        counts = {}
+        for token in tokenize(q_lower):
+            counts[token] = counts.get(token, 0) + 1
+        if not counts:
+            return None
+        terms = list(counts)
+        df = [self.post_ptr[self.vocab[t] + 1] - self.post_ptr[self.vocab[t]] if t in self.vocab else 0 for t in terms]
+        weights = (1 + np.log(np.asarray(list(counts.values()), dtype=np.float64))) * self.idf(df)
+        ids = np.arange(len(terms))
+        return embed(np.zeros(len(terms), dtype=np.int64), 1, ids, weights, feature_table(terms))[0]
+
+
+def _to_array(typecode: str, values):
+    """Copy a NumPy vector into a stdlib array, which pickles without NumPy installed."""
+    dtype = np.int64 if typecode == 'q' else np.intc
+    return array(typecode, np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+
+def top_k(ids, scores, k=None):
+    """
+    Return [(chunk position, score)] best-first, keeping only the k best when k is set.
+    """
+    if k is not None and k <= 0:
+        return []
+    if np is not None:
+        ids = np.asarray(ids)
+        scores = np.asarray(scores, dtype=np.float64)
+        if k is not None and k < len(scores):
+            keep = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[keep], scores[keep]
+        # Stable on the negated score so equal scores keep index order.
+        order = np.lexsort((ids, -scores))
+        return [(int(ids[i]), float(scores[i])) for i in order]
+    pairs = zip(ids, scores)
+    key = lambda pair: (-pair[1], pair[0])
+    if k is not None:
+        return sorted(heapq.nsmallest(k, pairs, key=key), key=key)
+    return sorted(pairs, key=key)
+
+
+def segment_name(index_name: str, generation: int) -> str:
+    """File name of one generation of an index's segment (index names may hold any characters)."""
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", index_name)[:64]
+    digest = hashlib.sha1(index_name.encode("utf-8")).hexdigest()[:8]
+    return f"{slug}-{digest}.v{generation}.pkl"
+
+
+def atomic_write(path: str, write):
+    """
+    Call write(f) on a temporary file, then rename it over path. The target is either
+    the old valid version or the new valid version, never a half-written one.
+    """
+    tmp_file = path + ".tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            write(f)
+        os.replace(tmp_file, path)
+    except Exception:
         if os.path.exists(tmp_file):
             try:
                 os.remove(tmp_file)
             except OSError:
                 pass
+        raise
+
+
+def save_manifest():
+    """Writes index_manifest to disk."""
+    payload = json.dumps({"version": 1, "indexes": index_manifest}, indent=2).encode("utf-8")
+    atomic_write(MANIFEST_FILE, lambda f: f.write(payload))
+
+
+def save_index(index_name: str, index):
+    """
+    Persists a single index as a new segment generation, then points the manifest at it
+    and removes the previous generation. Other indexes are not touched.
+    """
+    ensure_persistence_dir()
+    with index_lock:
+        previous = dict(index_manifest.get(index_name, {}))
+    generation = previous.get("generation", 0) + 1
+    segment = segment_name(index_name, generation)
+    store = segment[:-len(".pkl")] + ".txt"
+    try:
+        index.store.rename(os.path.join(SEGMENTS_DIR, store))
+        state = index.to_segment()
+        atomic_write(os.path.join(SEGMENTS_DIR, segment), lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL))
+        entry = {
+            "segment": segment,
+            "store": store,
+            "generation": generation,
+            "directory": index.directory,
+            "files": len(index.files or {}),
+            "chunks": len(index.chunks),
+            "bytes": os.path.getsize(os.path.join(SEGMENTS_DIR, segment)),
+        }
+        index.generation = generation
+        with index_lock:
+            index_manifest[index_name] = entry
+            save_manifest()
+            retired = file_indexes.get(index_name)
+        logging.info(f"Index '{index_name}' saved to {segment}")
+    except Exception as e:
+        logging.error(f"Failed to save index '{index_name}': {e}")
+        return
+    for key in ("segment", "store"):
+        stale = previous.get(key)
+        if stale and stale not in (segment, store):
+            path = os.path.join(SEGMENTS_DIR, stale)
+            # The previous generation's text store may still be mapped by searches in flight.
+            old_store = getattr(retired, "store", None) if retired is not index else None
+            if key == "store" and old_store is not None and old_store.path == path:
+                old_store.retire()
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def migrate_legacy_state():
+    """
+    One-time migration of the old single indexes.pkl snapshot into per-index segments.
+    The old file is kept as indexes.pkl.migrated.
+    """
+    try:
+        with open(PERSISTENCE_FILE, 'rb') as f:
+            legacy = pickle.load(f)
+    except Exception as e:
+        logging.error(f"Failed to load legacy indexes from {PERSISTENCE_FILE}: {e}")
+        return
+    for name, raw in legacy.items():
+        # Older pickles hold a bare chunk list or a path->content dict
+        index = RagIndex.from_legacy(raw.chunks if isinstance(raw, RagIndex) else raw)
+        put_index(name, index)
+    if all(name in index_manifest for name in legacy):
+        os.replace(PERSISTENCE_FILE, PERSISTENCE_FILE + ".migrated")
+    save_manifest()
+    enforce_memory_budget()
+    logging.info(f"Migrated {len(legacy)} indexes from {PERSISTENCE_FILE} to segments: {list(legacy.keys())}")
+
 
 def load_state():
-    """Loads file_indexes from disk if available."""
-    global file_indexes
+    """Loads the index manifest from disk; index bodies are read on first use."""
+    global index_manifest
     ensure_persistence_dir()
-    if os.path.exists(PERSISTENCE_FILE):
+    # Text stores left behind by builds that never finished
+    for name in os.listdir(SEGMENTS_DIR):
+        if name.startswith("build-") and name.endswith(".txt"):
+            try:
+                os.remove(os.path.join(SEGMENTS_DIR, name))
+            except OSError:
+                pass
+    if os.path.exists(MANIFEST_FILE):
         try:
-            with open(PERSISTENCE_FILE, 'rb') as f:
-                file_indexes = pickle.load(f)
-            logging.info(f"Loaded {len(file_indexes)} indexes from {PERSISTENCE_FILE}: {list(file_indexes.keys())}")
+            with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                index_manifest = json.load(f).get("indexes", {})
+            logging.info(f"Loaded manifest with {len(index_manifest)} indexes: {list(index_manifest.keys())}")
         except Exception as e:
-            logging.error(f"Failed to load indexes: {e}")
-            file_indexes = {}
+            logging.error(f"Failed to load index manifest: {e}")
+            index_manifest = {}
+    elif os.path.exists(PERSISTENCE_FILE):
+        migrate_legacy_state()
     else:
-        logging.info(f"No persistence file found at {PERSISTENCE_FILE}. Starting with empty indexes.")
+        logging.info(f"No manifest found at {MANIFEST_FILE}. Starting with empty indexes.")
 
-def create_index(index_name: str, directory_path: str):
+
+def current_rss():
+    """Resident set size of this process in bytes, or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def segment_bytes(index_name: str) -> int:
+    """On-disk segment size of an index, used as the estimate of what evicting it frees."""
+    entry = index_manifest.get(index_name) or {}
+    if "bytes" not in entry and "segment" in entry:
+        try:
+            entry["bytes"] = os.path.getsize(os.path.join(SEGMENTS_DIR, entry["segment"]))
+        except OSError:
+            return 0
+    return entry.get("bytes", 0)
+
+
+def index_bytes(index_name: str) -> int:
+    """
+    Estimate of what evicting an index frees: its segment size plus the in-memory caches
+    of its loaded generation (chunk vectors are about 4 KB per chunk), which are not saved.
+    """
+    index = file_indexes.get(index_name)
+    return segment_bytes(index_name) + (index.cache_bytes() if isinstance(index, RagIndex) else 0)
+
+
+def enforce_memory_budget(keep: str = None):
+    """
+    Evicts loaded indexes in least-recently-used order (never keep, and only ones with a
+    segment to reload from) until resident memory is back under RAG_MEMORY_BUDGET_MB.
+    """
+    if not MEMORY_BUDGET_MB:
+        return
+    with index_lock:
+        budget = MEMORY_BUDGET_MB * 1024 * 1024
+        rss = current_rss()
+        if rss is None:
+            rss = sum(index_bytes(name) for name in file_indexes)
+        for name in sorted(file_indexes, key=lambda n: index_last_used.get(n, 0)):
+            if rss <= budget:
+                break
+            if name == keep or name not in index_manifest:
+                continue
+            # The allocator may not hand freed memory straight back, so count the estimate instead of re-measuring.
+            rss -= index_bytes(name)
+            del file_indexes[name]
+            index_last_used.pop(name, None)
+            evicted_indexes.add(name)
+            logging.info(f"Evicted index '{name}' to stay under the {MEMORY_BUDGET_MB:g} MB memory budget.")
+
+
+def get_index(index_name: str):
+    """
+    Returns the current generation of a named index, reading its segment from disk on
+    first use (or after eviction) and marking it most recently used. Loaded indexes are
+    returned without taking index_lock.
+    """
+    index = file_indexes.get(index_name)
+    if index is None:
+        with index_lock:
+            index = file_indexes.get(index_name)
+            if index is None:
+                entry = index_manifest.get(index_name)
+                if entry is None:
+                    raise RuntimeError(f"Index '{index_name}' not found. Please run 'create_index' first.")
+                with open(os.path.join(SEGMENTS_DIR, entry["segment"]), 'rb') as f:
+                    state = pickle.load(f)
+                store = TextStore(os.path.join(SEGMENTS_DIR, entry["store"])) if entry.get("store") else None
+                index = RagIndex.from_segment(state, store)
+                index.generation = entry.get("generation", 0)
+                file_indexes[index_name] = index
+                index_last_used[index_name] = next(_use_clock)
+                evicted_indexes.discard(index_name)
+                enforce_memory_budget(keep=index_name)
+    index_last_used[index_name] = next(_use_clock)
+    return index
+
+
+def put_index(index_name: str, index):
+    """Persists a freshly built index, then installs it as the most recently used one."""
+    save_index(index_name, index)
+    with index_lock:
+        file_indexes[index_name] = index
+        index_last_used[index_name] = next(_use_clock)
+        evicted_indexes.discard(index_name)
+        enforce_memory_budget(keep=index_name)
+    # Results of older generations can never be hit again.
+    result_cache.invalidate(index_name)
+
+def scan_text_files(directory_path: str):
+    """
+    Walk a directory tree once with os.scandir and return {path: (mtime, size)}
+    for every text file (.txt, .md). Like os.walk, symlinked directories are not followed.
+    """
+    found = {}
+    pending = [directory_path]
+    while pending:
+        current = pending.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.name.endswith(('.txt', '.md')):
+                            st = entry.stat()
+                            found[entry.path] = (st.st_mtime, st.st_size)
+                    except OSError as e:
+                        logging.warning(f"Skipping '{entry.path}': {e}")
+        except OSError as e:
+            logging.warning(f"Skipping directory '{current}': {e}")
+    return found
+
+
+def create_index(index_name: str, directory_path: str, collapse_duplicates: bool = False):
     """
     Scans a directory recursively, reads all text files (.txt, .md),
     and stores chunked content in a named in-memory index for searching.
+    Re-running it on an existing index of the same directory only re-chunks
+    files whose mtime/size and content hash changed, and drops deleted files.
+    Files with identical content are stored once: later paths become aliases
+    of the first, and content the previous index already holds (for instance
+    a renamed file) is carried over rather than re-chunked. With
+    collapse_duplicates, near-duplicate chunks are hidden from searches,
+    keeping the first of each group (in path order).
     """
-    global file_indexes
     directory_path = normalize_path(directory_path)
     if not os.path.isdir(directory_path):
         raise FileNotFoundError(f"The directory '{directory_path}' does not exist.")
 
-    current_index = []
-    indexed_files = 0
-    skipped_count = 0
-
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            if file.endswith(('.txt', '.md')):
-                file_path = os.path.join(root, file)
+    with index_lock:
+        build_lock = build_locks.setdefault(index_name, threading.Lock())
+    with build_lock:
+        previous = None
+        if index_name in file_indexes or index_name in index_manifest:
+            try:
+                previous = get_index(index_name)
+            except Exception as e:
+                logging.warning(f"Rebuilding index '{index_name}' from scratch: {e}")
+        if not (isinstance(previous, RagIndex) and previous.files is not None and previous.directory == directory_path):
+            previous = None
+
+        found = scan_text_files(directory_path)
+        if previous and (previous.hidden is not None) == bool(collapse_duplicates) and found.keys() == previous.files.keys() and all(
+            found[fp] == (known["mtime"], known["size"]) for fp, known in previous.files.items()
+        ):
+            summary = (
+                f"Index '{index_name}' is up to date. {len(found)} files indexed, {len(previous.chunks)} chunks "
+                f"(0 added, 0 updated, 0 removed, {len(found)} unchanged)."
+            )
+            return [{"type": "text", "text": summary}]
+
+        # Content hashes tell which files are copies of each other. Only files of the same
+        # size can be, so changed files are hashed up front only when their size is shared
+        # (with another file, or with content the previous index holds); the hashes of
+        # files whose mtime/size are unchanged are known already.
+        paths = sorted(found)
+        known_files = previous.files if previous else {}
+        stored = {}  # sha1 -> previous path whose chunks hold that content
+        for file_path, known in known_files.items():
+            if "alias" not in known:
+                stored.setdefault(known["sha1"], file_path)
+        size_counts = {}
+        for _, size in found.values():
+            size_counts[size] = size_counts.get(size, 0) + 1
+        stored_sizes = {known_files[file_path]["size"] for file_path in stored.values()}
+        hashes = {}
+        for file_path in paths:
+            check_cancelled()
+            known = known_files.get(file_path)
+            mtime, size = found[file_path]
+            if known and (known["mtime"], known["size"]) == (mtime, size):
+                hashes[file_path] = known["sha1"]
+            elif size_counts[size] > 1 or size in stored_sizes:
                 try:
-                    mtime = os.path.getmtime(file_path)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    tags = extract_tags(content)
-                    chunks = chunk_text(content)
-                    for idx, chunk in enumerate(chunks):
-                        current_index.append({
-                            "file": file_path,
-                            "chunk_id": idx + 1,
-                            "text": chunk,
-                            "mtime": mtime,
-                            "tags": tags,
-                        })
-                    indexed_files += 1
-                except Exception as e:
+                    hashes[file_path] = file_sha1(file_path)
+                except OSError:
+                    pass  # Read (and reported) with the other files below.
+        first_with = {}
+        for file_path in paths:
+            if file_path in hashes:
+                first_with.setdefault(hashes[file_path], file_path)
+
+        # Each file is an alias of the first file with its content, carried over from the
+        # previous index, or read, hashed and analyzed (in parallel worker processes for
+        # larger jobs).
+        plan = {}
+        tasks = []
+        for file_path in paths:
+            digest = hashes.get(file_path)
+            known = known_files.get(file_path)
+            if digest is not None and first_with[digest] != file_path:
+                plan[file_path] = ("alias", first_with[digest])
+            elif digest is not None and digest in stored:
+                plan[file_path] = ("reuse", known_files[stored[digest]])
+            else:
+                reusable = known if known and "alias" not in known else None
+                plan[file_path] = ("read", reusable)
+                tasks.append((file_path, reusable["sha1"] if reusable else None, found[file_path][1], SEGMENTS_DIR))
+        pool = None
+        workers = min(INDEX_WORKERS, len(tasks), sum(task[2] for task in tasks) // max(1, PARALLEL_INDEX_MIN_BYTES))
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+        current_index = ChunkTable()
+        reused = []
+        fragments = []
+        files = {}
+        added = updated = unchanged = aliased = 0
+        skipped_count = 0
+        writer = TextStoreWriter()
+
+        try:
+            # Results come in task order, so chunks are numbered in path order however many workers run.
+            if pool is not None:
+                results = ordered_results(pool, index_file, tasks, 2 * workers)
+            else:
+                results = map(index_file, tasks)
+            for file_path in paths:
+                check_cancelled()
+                mtime, size = found[file_path]
+                action, source = plan[file_path]
+                if action == "alias":
+                    target = files.get(source)
+                    if target is None or "alias" in target:
+                        logging.warning(f"Skipping file '{file_path}': it has the same content as '{source}', which could not be read.")
+                        skipped_count += 1
+                        continue
+                    files[file_path] = {
+                        "mtime": mtime, "size": size, "sha1": target["sha1"], "alias": source,
+                        "offset": target["offset"], "length": 0,
+                        "start": len(current_index), "end": len(current_index),
+                    }
+                    aliased += 1
+                    continue
+                known = known_files.get(file_path)
+                if action == "reuse":
+                    result = {"sha1": hashes[file_path]}
+                else:
+                    result = next(results)
+                if "error" in result:
                     # Log the specific error and increment skipped count
-                    logging.warning(f"Skipping file '{file_path}': {e}")
+                    logging.warning(f"Skipping file '{file_path}': {result['error']}")
                     skipped_count += 1
-
-    file_indexes[index_name] = current_index
-    save_state() # Persist changes
-
-    summary = f"Successfully created index '{index_name}'. {indexed_files} files indexed, {len(current_index)} chunks."
+                    continue
+
+                start = len(current_index)
+                if "fragment" not in result:
+                    # Content the previous index holds: copy its packed text over and shift its chunks' byte ranges.
+                    source = source or known
+                    offset = writer.append_range(previous.store, source["offset"], source["offset"] + source["length"])
+                    delta = offset - source["offset"]
+                    table = previous.chunks
+                    fid = current_index.add_file(file_path, table.tags(source["start"]) if source["end"] > source["start"] else [])
+                    for old in range(source["start"], source["end"]):
+                        current_index.append(fid, table.chunk_id[old], table.start[old] + delta, table.end[old] + delta, mtime,
+                                             table.src_start[old], table.src_end[old])
+                        reused.append(old)
+                    length = source["length"]
+                    if known and (known["mtime"], known["size"]) == (mtime, size):
+                        unchanged += 1
+                    elif known:
+                        updated += 1
+                    else:
+                        added += 1
+                else:
+                    if "packed_path" in result:
+                        try:
+                            offset = writer.append_file(result["packed_path"])
+                        finally:
+                            os.remove(result["packed_path"])
+                    else:
+                        offset = writer.append(result["packed"])
+                    fid = current_index.add_file(file_path, result["tags"])
+                    for idx, ((lo, hi), (src_lo, src_hi)) in enumerate(zip(result["spans"], result["sources"])):
+                        current_index.append(fid, idx + 1, offset + lo, offset + hi, mtime, src_lo, src_hi)
+                        reused.append(-1)
+                    fragments.append((range(start, len(current_index)), result["fragment"]))
+                    length = result["length"]
+                    if known:
+                        updated += 1
+                    else:
+                        added += 1
+                files[file_path] = {
+                    "mtime": mtime, "size": size, "sha1": result["sha1"],
+                    "offset": offset, "length": length,
+                    "start": start, "end": len(current_index),
+                }
+        except BaseException:
+            writer.discard()
+            raise
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        store = writer.close()
+
+        if previous is None:
+            index = RagIndex(current_index, store, fragments, files, directory_path)
+            summary = f"Successfully created index '{index_name}'. {len(files)} files indexed, {len(current_index)} chunks."
+        else:
+            removed = len(previous.files.keys() - files.keys())
+            index = RagIndex(current_index, store, fragments, files, directory_path, previous, reused)
+            summary = (
+                f"Successfully updated index '{index_name}'. {len(files)} files indexed, {len(current_index)} chunks "
+                f"({added} added, {updated} updated, {removed} removed, {unchanged} unchanged)."
+            )
+        if aliased:
+            summary += f"\n{aliased} files have the same content as another file and are stored once."
+        if collapse_duplicates and np is not None:
+            summary += f"\n{index.collapse_duplicates()} near-duplicate chunks collapsed."
+        elif collapse_duplicates:
+            summary += "\nNear-duplicate collapsing needs NumPy, which is not installed; nothing was collapsed."
+        put_index(index_name, index)
     if skipped_count > 0:
         summary += f"\nWarning: {skipped_count} files could not be read and were skipped (check server logs for details)."
 
     return [{"type": "text", "text": summary}]
 
-def search_index(index_name: str, query: str, fuzzy: bool = False, threshold: float = 0.5, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None):
+class ResultCache:
+    """
+    Bounded LRU of search_index results (treated as read-only once cached). Keys include
+    the index generation, so a rebuilt index never serves stale results; an entry's size
+    is the length of its JSON encoding.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, content):
+        size = len(json.dumps(content))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (content, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.size -= dropped
+
+    def invalidate(self, index_name: str):
+        """Drops every cached result of an index."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == index_name]:
+                self.size -= self._entries.pop(key)[1]
+
+    def stats(self) -> str:
+        with self._lock:
+            return (
+                f"{len(self._entries)} entries, {self.size / 1024:.1f} KB of {self.max_bytes / (1024 * 1024):g} MB, "
+                f"{self.hits} hits, {self.misses} misses"
+            )
+
+
+result_cache = ResultCache(int(RESULT_CACHE_MB * 1024 * 1024))
+
+
+def search_index(index_name: str, query: str, fuzzy: bool = False, threshold: float = 0.5, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None, ranked: bool = False, limit: int = None, offset: int = 0, regex: bool = False, snippet_width: int = SNIPPET_WIDTH, mode: str = "keyword", dedupe: bool = False, boolean: bool = False):
     """
     Search a chunked index with optional fuzzy matching and basic filters.
+    With ranked=True, chunks containing any query word are scored with BM25 and
+    returned best-first. With regex=True, query is a case-insensitive regular
+    expression, pre-filtered through the trigram index. mode="vector" instead ranks
+    chunks by cosine similarity to the query's hashed TF-IDF vector, and "hybrid"
+    fuses that ranking with BM25's by reciprocal rank fusion. limit/offset page through
+    the results in any mode, SEARCH_PAGE_SIZE (VECTOR_TOP_K for vector and hybrid) at a
+    time by default. Snippets are built for the returned page only; they are centred on
+    the matches, which are highlighted and also returned as offsets in structuredContent.
+    With dedupe=True, hits that are near-duplicates of a better hit are dropped. With
+    boolean=True, query is a boolean query (see parse_query): whole words, "quoted
+    phrases", AND/OR/NOT, parentheses and path:/tag:/after:/before: filters. Results are
+    cached per index generation.
+    """
+    mode = mode or "keyword"
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode '{mode}'; expected one of: {', '.join(SEARCH_MODES)}.")
+    if mode != "keyword" and np is None:
+        raise ValueError(f"Search mode '{mode}' needs NumPy, which is not installed.")
+    if dedupe and np is None:
+        raise ValueError("dedupe needs NumPy, which is not installed.")
+    current_index = get_index(index_name)
+    key = (index_name, current_index.generation, query, fuzzy, threshold, path_contains, tag,
+           min_mtime, max_mtime, ranked, limit, offset, regex, snippet_width, mode, dedupe, boolean)
+    # Generation 0 is an index that was never saved, so its key would not be unique.
+    cacheable = RESULT_CACHE_MB > 0 and current_index.generation > 0
+    if cacheable:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+    result = run_search(current_index, index_name, query, fuzzy, threshold, path_contains, tag,
+                        min_mtime, max_mtime, ranked, limit, offset, regex, snippet_width, mode, dedupe, boolean)
+    if mode != "keyword" or dedupe or fuzzy:
+        # The first vector, dedupe or fuzzy search builds caches that count toward the budget.
+        enforce_memory_budget(keep=index_name)
+    if cacheable:
+        result_cache.put(key, result)
+    return result
+
+
+class DuplicateFilter:
     """
-    if index_name not in file_indexes:
-        raise RuntimeError(f"Index '{index_name}' not found. Please run 'create_index' first.")
+    Result-time near-duplicate filter: feed hits best-first to is_duplicate, which says
+    whether a hit is a near-duplicate of one already kept (a shared LSH band key and
+    signatures agreeing on >= threshold), and keeps it otherwise.
+    """
+    def __init__(self, index, threshold: float = DUPLICATE_THRESHOLD):
+        self.signatures = index.signatures()
+        self.keys = index.band_keys()
+        self.doc_len = index.doc_len
+        self.threshold = threshold
+        self.kept = {}  # (band, key) -> kept chunk ids
+
+    def is_duplicate(self, idx: int) -> bool:
+        if not self.doc_len[idx]:
+            return False
+        buckets = list(enumerate(self.keys[idx].tolist()))
+        candidates = {other for bucket in buckets for other in self.kept.get(bucket, ())}
+        row = self.signatures[idx]
+        if any((self.signatures[other] == row).mean() >= self.threshold for other in candidates):
+            return True
+        for bucket in buckets:
+            self.kept.setdefault(bucket, []).append(idx)
+        return False
+
+    def filter(self, hits, k: int = None):
+        """Best-first (chunk id, score) hits without the near-duplicates, the first k of them."""
+        kept = []
+        for idx, score in hits:
+            if k is not None and len(kept) >= k:
+                break
+            if not self.is_duplicate(idx):
+                kept.append((idx, score))
+        return kept
 
-    current_index = file_indexes[index_name]
-    # Backward compatibility: old dict format path->content
-    if isinstance(current_index, dict):
-        upgraded = []
-        for fp, content in current_index.items():
-            upgraded.append({"file": fp, "chunk_id": 1, "text": content, "mtime": 0, "tags": []})
-        current_index = upgraded
-        file_indexes[index_name] = upgraded
+
+def query_terms(current_index, q_lower: str, fuzzy: bool = False, threshold: float = 0.5):
+    """Vocabulary terms a query looks for: its words plus, with fuzzy, their close matches."""
+    terms = tokenize(q_lower)
+    if fuzzy:
+        terms = [t for token in terms for t in current_index.fuzzy_terms(token, threshold or 0.6)] + terms
+    return terms
+
+
+def parse_query(query: str):
+    """
+    Parse a boolean query (see QUERY_TOKEN_RE) into a tree of tuples: ("word", term),
+    ("phrase", [terms]), ("field", name, value), ("not", node), ("and", [nodes]) and
+    ("or", [nodes]). NOT binds tightest, then AND, then OR. A word that tokenizes into
+    several terms (e.g. "e-mail") is a phrase; one without word characters is dropped.
+    Returns None for a query with no terms; raises ValueError on syntax errors.
+    """
+    tokens = []
+    pos = 0
+    query = query or ""
+    while pos < len(query):
+        m = QUERY_TOKEN_RE.match(query, pos)
+        if m is None:
+            if query[pos:].strip():
+                raise ValueError(f"Invalid query: unbalanced quote at character {pos}.")
+            break
+        pos = m.end()
+        if m.group("paren"):
+            tokens.append((m.group("paren"),))
+        elif m.group("field"):
+            value = m.group("quoted") if m.group("quoted") is not None else m.group("value")
+            tokens.append(("field", m.group("field"), value))
+        elif m.group("word") in ("AND", "OR", "NOT"):
+            tokens.append((m.group("word"),))
+        else:
+            terms = tokenize(m.group("phrase") if m.group("phrase") is not None else m.group("word"))
+            if terms:
+                tokens.append(("word", terms[0]) if len(terms) == 1 and m.group("word") else ("phrase", terms))
+
+    def parse_or(k):
+        nodes = []
+        while True:
+            node, k = parse_and(k)
+            nodes.append(node)
+            if k < len(tokens) and tokens[k] == ("OR",):
+                k += 1
+                continue
+            return (nodes[0] if len(nodes) == 1 else ("or", nodes)), k
+
+    def parse_and(k):
+        nodes = []
+        while k < len(tokens) and tokens[k] not in (("OR",), (")",)):
+            if tokens[k] == ("AND",):
+                if not nodes:
+                    raise ValueError("Invalid query: AND needs a term on each side.")
+                k += 1
+            node, k = parse_not(k)
+            nodes.append(node)
+        if not nodes:
+            raise ValueError("Invalid query: expected a term.")
+        return (nodes[0] if len(nodes) == 1 else ("and", nodes)), k
+
+    def parse_not(k):
+        if k >= len(tokens):
+            raise ValueError("Invalid query: expected a term at the end.")
+        token = tokens[k]
+        if token == ("NOT",):
+            node, k = parse_not(k + 1)
+            return ("not", node), k
+        if token == ("(",):
+            node, k = parse_or(k + 1)
+            if k >= len(tokens) or tokens[k] != (")",):
+                raise ValueError("Invalid query: missing ')'.")
+            return node, k + 1
+        if token[0] in ("word", "phrase", "field"):
+            return token, k + 1
+        raise ValueError(f"Invalid query: unexpected '{token[0]}'.")
+
+    if not tokens:
+        return None
+    node, k = parse_or(0)
+    if k < len(tokens):
+        raise ValueError(f"Invalid query: unexpected '{tokens[k][0]}'.")
+    return node
+
+
+def query_time(value: str) -> float:
+    """after:/before: value as a timestamp: seconds since the epoch, or an ISO date/time."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid query: '{value}' is not a date (use YYYY-MM-DD or seconds since the epoch).")
+
+
+def push_down_filters(node, path_contains: str, tag: str, min_mtime, max_mtime):
+    """
+    Split the field filters ANDed at the top of a parsed query into ChunkTable.select
+    arguments, merged with the tool's own filters. Returns (remaining query or None,
+    (path_contains, tag, min_mtime, max_mtime)). select takes one path and one tag, so
+    any further path:/tag: filters stay in the query.
+    """
+    children = node[1] if node is not None and node[0] == "and" else [node] if node is not None else []
+    rest = []
+    for child in children:
+        if child[0] != "field":
+            rest.append(child)
+            continue
+        name, value = child[1], child[2]
+        if name == "after":
+            t = query_time(value)
+            min_mtime = t if min_mtime is None else max(min_mtime, t)
+        elif name == "before":
+            t = query_time(value)
+            max_mtime = t if max_mtime is None else min(max_mtime, t)
+        elif name == "path" and not path_contains:
+            path_contains = value.lower()
+        elif name == "tag" and not tag:
+            tag = value.lower()
+        else:
+            rest.append(child)
+    remaining = None if not rest else rest[0] if len(rest) == 1 else ("and", rest)
+    return remaining, (path_contains, tag, min_mtime, max_mtime)
+
+
+def query_cost(current_index, node) -> float:
+    """Rough number of chunks a query node reads, used to order AND operands."""
+    if node[0] == "word":
+        return current_index.document_frequency(node[1])
+    if node[0] == "phrase":
+        return min(current_index.document_frequency(t) for t in node[1])
+    if node[0] == "field":
+        return 0
+    return len(current_index.chunks)
+
+
+def boolean_chunks(current_index, node, within, fuzzy: bool = False, threshold: float = 0.5):
+    """
+    Set of chunks matching a parsed query node, restricted to the chunk set within
+    (None = all). AND evaluates its cheapest operand first and narrows the rest to what
+    is left, and subtracts NOT operands last, so selective terms and filters prune early.
+    """
+    kind = node[0]
+    if kind == "word":
+        terms = [node[1]]
+        if fuzzy:
+            terms += current_index.fuzzy_terms(node[1], threshold or 0.6)
+        found = set()
+        for term in dict.fromkeys(terms):
+            found |= current_index.term_chunks(term, within)
+        return found
+    if kind == "phrase":
+        return current_index.phrase_chunks(node[1], within)
+    if kind == "field":
+        _, args = push_down_filters(node, "", "", None, None)
+        ids = current_index.select(*args)
+        ids = set(ids.tolist() if np is not None else ids)
+        return ids if within is None else ids & within
+    universe = within if within is not None else set(range(len(current_index.chunks)))
+    if kind == "not":
+        return universe - boolean_chunks(current_index, node[1], within, fuzzy, threshold)
+    if kind == "or":
+        found = set()
+        for child in node[1]:
+            found |= boolean_chunks(current_index, child, within, fuzzy, threshold)
+        return found
+    positives = sorted((c for c in node[1] if c[0] != "not"), key=lambda c: query_cost(current_index, c))
+    found = within if positives else universe
+    for child in positives:
+        found = boolean_chunks(current_index, child, found, fuzzy, threshold)
+        if not found:
+            return set()
+    for child in node[1]:
+        if child[0] == "not":
+            found = found - boolean_chunks(current_index, child[1], found, fuzzy, threshold)
+    return found
+
+
+def positive_terms(current_index, node, fuzzy: bool = False, threshold: float = 0.5):
+    """Vocabulary terms a parsed query looks for outside NOT, for ranking and highlighting."""
+    if node is None or node[0] in ("not", "field"):
+        return []
+    if node[0] == "word":
+        return [node[1]] + (current_index.fuzzy_terms(node[1], threshold or 0.6) if fuzzy else [])
+    if node[0] == "phrase":
+        return list(node[1])
+    return [t for child in node[1] for t in positive_terms(current_index, child, fuzzy, threshold)]
+
+
+def snippet_hit(index_name: str, current_index, idx: int, text: str, spans, width: int = SNIPPET_WIDTH, score=None):
+    """
+    Snippet of one search hit plus its structured form. Offsets are character offsets
+    into the chunk text: the snippet window and every match in the chunk.
+    """
+    chunks = current_index.chunks
+    snippet, (start, end), _ = make_snippet(text, spans, width)
+    item = {
+        "index": index_name,
+        "path": chunks.path(idx),
+        "chunk_id": chunks.chunk_id[idx],
+        "snippet": snippet,
+        "snippet_start": start,
+        "snippet_end": end,
+        "matches": [[a, b] for a, b in sorted(set(spans))],
+    }
+    also_in = current_index.aliases().get(chunks.file[idx])
+    if also_in:
+        item["also_in"] = also_in
+    if chunks.src_start[idx] >= 0:
+        # Byte range of the whole chunk in the source file, e.g. for read_file.
+        item["file_start"] = chunks.src_start[idx]
+        item["file_end"] = chunks.src_end[idx]
+    if score is not None:
+        item["score"] = round(float(score), 6)
+    return snippet, item
+
+
+def allowed_mask(n: int, allowed):
+    """Boolean mask over n chunks of the allowed chunk ids from ChunkTable.select."""
+    mask = np.zeros(n, dtype=bool)
+    mask[allowed] = True
+    return mask
+
+
+def rank_chunks(current_index, q_lower: str, fuzzy: bool, threshold: float, allowed, k: int = None, mask=None):
+    """
+    Best-first (chunk id, BM25 score) pairs for a lowercased query, restricted to the
+    allowed chunk ids from ChunkTable.select (None = all), at most k of them. mask is
+    allowed as an allowed_mask, when the caller already has one.
+    """
+    ids, scores = current_index.bm25(query_terms(current_index, q_lower, fuzzy, threshold))
+    if allowed is not None and np is not None and len(ids):
+        if mask is None:
+            mask = allowed_mask(len(current_index.chunks), allowed)
+        keep = mask[ids]
+        ids, scores = ids[keep], scores[keep]
+    elif allowed is not None:
+        allowed_set = set(allowed)
+        kept = [(idx, score) for idx, score in zip(ids, scores) if idx in allowed_set]
+        ids, scores = [h[0] for h in kept], [h[1] for h in kept]
+    return top_k(ids, scores, k)
+
+
+def vector_chunks(current_index, q_lower: str, allowed, k: int = None):
+    """
+    Best-first (chunk id, cosine similarity) pairs for a lowercased query in vector mode:
+    one matrix-vector product over the index's chunk vectors, restricted to the allowed
+    chunk ids (None = all) and to positive similarities, at most k of them. A selective
+    filter is pushed down, so only the allowed rows are multiplied.
+    """
+    matrix = current_index.vectors()
+    q = current_index.query_vector(q_lower)
+    if q is None or not len(matrix):
+        return []
+    if allowed is None:
+        ids = np.arange(len(matrix))
+        scores = matrix @ q
+    else:
+        ids = np.asarray(allowed, dtype=np.int64)
+        scores = matrix[ids] @ q if 4 * len(ids) < len(matrix) else (matrix @ q)[ids]
+    keep = scores > 0
+    return top_k(ids[keep], scores[keep], k)
+
+
+def hybrid_chunks(current_index, q_lower: str, fuzzy: bool, threshold: float, allowed, k: int = None):
+    """
+    Best-first (chunk id, fused score) pairs for hybrid mode. BM25 and vector retrieval
+    run concurrently over the same allowed chunks (the filters are resolved once, by the
+    caller, and shared), and their rankings are fused by reciprocal rank fusion.
+    """
+    depth = max(k or 0, HYBRID_DEPTH)
+    mask = None if allowed is None else allowed_mask(len(current_index.chunks), allowed)
+    cancelled = getattr(_request_context, "cancelled", None)
+
+    def vector_side():
+        # Let a first-use vector build notice if the request is cancelled.
+        _request_context.cancelled = cancelled
+        try:
+            return vector_chunks(current_index, q_lower, allowed, depth)
+        finally:
+            _request_context.cancelled = None
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        vector_future = pool.submit(vector_side)
+        keyword_hits = rank_chunks(current_index, q_lower, fuzzy, threshold, allowed, depth, mask)
+        vector_hits = vector_future.result()
+    fused = {}
+    for hits in (keyword_hits, vector_hits):
+        for rank, (idx, _) in enumerate(hits, 1):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (RRF_K + rank)
+    return top_k(list(fused), list(fused.values()), k)
+
+
+def hit_label(current_index, idx: int) -> str:
+    """"[path] chunk N" for a search hit, plus any other paths with the same content."""
+    chunks = current_index.chunks
+    label = f"[{chunks.path(idx)}] chunk {chunks.chunk_id[idx]}"
+    also_in = current_index.aliases().get(chunks.file[idx])
+    return label + (f" (same content in: {', '.join(also_in)})" if also_in else "")
+
+
+def page_results(index_name: str, current_index, hits, offset: int, stop: int, spans_of, snippet_width: int = SNIPPET_WIDTH):
+    """
+    Rendered results and structured items for the page hits[offset:stop] of ordered
+    (chunk id, score or None) hits, plus the offset of the next page (None when there
+    is no hit past stop). Match spans, from spans_of(idx, text), and snippets are built
+    for the page only.
+    """
+    results, items = [], []
+    for idx, score in hits[offset:stop]:
+        text = current_index.text(idx)
+        snippet, item = snippet_hit(index_name, current_index, idx, text, spans_of(idx, text), snippet_width, score)
+        label = hit_label(current_index, idx) if score is None else f"{hit_label(current_index, idx)} (score {score:.3f})"
+        results.append(f"{label}\n{snippet}\n")
+        items.append(item)
+    return results, items, (stop if len(hits) > stop else None)
+
+
+def term_spans(current_index, terms):
+    """spans_of for page_results: the recorded positions of the given vocabulary terms."""
+    return lambda idx, text: current_index.match_spans(idx, text, terms)
+
+
+def run_search(current_index, index_name, query, fuzzy, threshold, path_contains, tag, min_mtime, max_mtime, ranked, limit, offset, regex, snippet_width=SNIPPET_WIDTH, mode="keyword", dedupe=False, boolean=False):
+    """The uncached body of search_index, run against one index generation."""
+
+    if boolean and (regex or mode != "keyword"):
+        raise ValueError("boolean applies to keyword mode without regex only.")
+    pattern = None
+    if regex:
+        try:
+            pattern = re.compile(query or "", re.IGNORECASE)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression '{query}': {e}")
+    if pattern is not None and mode != "keyword":
+        raise ValueError("regex applies to keyword mode only.")
 
     q_lower = (query or "").lower()
     path_filter = (path_contains or "").lower()
     tag_filter = (tag or "").lower()
-    results = []
 
-    def passes_filters(entry):
-        if path_filter and path_filter not in entry.get("file", "").lower():
-            return False
-        if tag_filter and tag_filter not in (entry.get("tags") or []):
-            return False
-        mt = entry.get("mtime")
-        if min_mtime is not None and mt and mt < min_mtime:
-            return False
-        if max_mtime is not None and mt and mt > max_mtime:
-            return False
-        return True
+    if limit is not None and int(limit) < 1:
+        raise ValueError("limit must be at least 1.")
+    offset = max(0, int(offset or 0))
+    stop = offset + (int(limit) if limit is not None else SEARCH_PAGE_SIZE if mode == "keyword" else VECTOR_TOP_K)
+    # Every mode finds one hit past the page, to tell whether there is a next page.
+    k = stop + 1
+    duplicates = DuplicateFilter(current_index) if dedupe else None
+    # Deduplicating needs the hits beyond the top k to refill the dropped ones.
+    depth = None if duplicates else k
+
+    if boolean:
+        hits, terms = boolean_hits(current_index, query, fuzzy, threshold, path_filter, tag_filter,
+                                   min_mtime, max_mtime, ranked)
+        spans_of = term_spans(current_index, terms)
+    else:
+        # Filters run first, through the filter index, and narrow everything below.
+        allowed = current_index.select(path_filter, tag_filter, min_mtime, max_mtime)
+        if mode == "vector":
+            hits = vector_chunks(current_index, q_lower, allowed, depth)
+            spans_of = term_spans(current_index, query_terms(current_index, q_lower))
+        elif mode == "hybrid":
+            hits = hybrid_chunks(current_index, q_lower, fuzzy, threshold, allowed, depth)
+            spans_of = term_spans(current_index, query_terms(current_index, q_lower, fuzzy, threshold))
+        elif ranked and pattern is None:
+            hits = rank_chunks(current_index, q_lower, fuzzy, threshold, allowed, depth)
+            spans_of = term_spans(current_index, query_terms(current_index, q_lower, fuzzy, threshold))
+        else:
+            # The scan checks duplicates itself, so it can stop at the first k kept hits.
+            hits, spans_of = scan_hits(current_index, query, q_lower, pattern, fuzzy, threshold, allowed, k, duplicates)
+            duplicates = None
+    if duplicates:
+        hits = duplicates.filter(hits, k)
+    results, items, next_offset = page_results(index_name, current_index, hits, offset, stop, spans_of, snippet_width)
+    return search_result(results, items, query, index_name, next_offset)
 
-    for entry in current_index:
-        if not passes_filters(entry):
-            continue
-        text = entry.get("text", "")
+
+def scan_hits(current_index, query, q_lower, pattern, fuzzy, threshold, allowed, k, duplicates=None):
+    """
+    The first k chunks, in index order, containing the literal query (or matching the
+    regex pattern, or, with fuzzy, close to its words), among the allowed chunk ids
+    (None = all), skipping near-duplicates when given a DuplicateFilter. Returns
+    ((chunk id, None) hits, spans_of for page_results).
+    """
+    chunks = current_index.chunks
+    # Postings (or, for regexes and queries without word characters, trigrams) narrow the
+    # search; each candidate is still verified against the chunk text below.
+    # Fuzzy matching adds chunks whose words are close to the query words in the vocabulary.
+    if pattern is not None:
+        try:
+            required = regex_literals(sre_parse.parse(query or "", re.IGNORECASE))
+        except Exception:
+            required = []
+        found = current_index.regex_candidates(required)
+        candidates = None if found is None else sorted(found)
+    else:
+        candidates = current_index.candidates(q_lower) if q_lower else []
+        if candidates is None:
+            found = current_index.trigram_chunks(q_lower)
+            candidates = None if found is None else sorted(found)
+    candidate_set = None if candidates is None else set(candidates)
+    fuzzy_set = set()
+    fuzzy_terms = []
+    if fuzzy and q_lower and pattern is None:
+        fuzzy_set = set(current_index.fuzzy_candidates(q_lower, threshold or 0.6))
+        fuzzy_terms = [t for token in tokenize(q_lower) for t in current_index.fuzzy_terms(token, threshold or 0.6)]
+        if candidates is not None:
+            candidates = sorted(candidate_set | fuzzy_set)
+    # Matches of the literal query, for snippets.
+    literal = re.compile(re.escape(query or ""), re.IGNORECASE) if pattern is None and q_lower else pattern
+    if allowed is None:
+        scan = range(len(chunks)) if candidates is None else candidates
+    else:
+        allowed = allowed.tolist() if np is not None else allowed
+        if candidates is None:
+            scan = allowed
+        else:
+            allowed_set = set(allowed)
+            scan = [idx for idx in candidates if idx in allowed_set]
+
+    hits = []
+    for idx in scan:
         matched = False
-        if q_lower and q_lower in text.lower():
+        if pattern is not None:
+            matched = pattern.search(current_index.text(idx)) is not None
+        elif q_lower and (candidate_set is None or idx in candidate_set) and q_lower in current_index.text(idx).lower():
+            matched = True
+        elif idx in fuzzy_set:
             matched = True
-        elif fuzzy and q_lower:
-            matched = fuzzy_match(query, text, threshold or 0.6)
+        if matched and duplicates is not None and duplicates.is_duplicate(idx):
+            continue
         if matched:
-            snippet = text[:300]
-            results.append(f"[{entry.get('file')}] chunk {entry.get('chunk_id')}\n{snippet}\n")
+            hits.append((idx, None))
+            if len(hits) >= k:
+                break
+
+    def spans_of(idx, text):
+        spans = current_index.match_spans(idx, text, pattern=literal) if literal is not None else []
+        if idx in fuzzy_set:
+            spans += current_index.match_spans(idx, text, fuzzy_terms)
+        return spans
+    return hits, spans_of
+
 
+def boolean_hits(current_index, query, fuzzy, threshold, path_contains, tag, min_mtime, max_mtime, ranked):
+    """
+    Hits for search_index's boolean=True: parse the query, push its top-level field
+    filters into the filter index along with the tool's filters, and evaluate the rest
+    against the postings (phrases against token positions). Returns ((chunk id, score)
+    hits, the query's positive terms): hits in index order with None scores, or
+    best-first by BM25 over the positive terms with ranked=True.
+    """
+    node, filters = push_down_filters(parse_query(query), path_contains, tag, min_mtime, max_mtime)
+    allowed = current_index.select(*filters)
+    if node is None and allowed is None:
+        return [], []
+    within = None if allowed is None else set(allowed.tolist() if np is not None else allowed)
+    matched = within if node is None else boolean_chunks(current_index, node, within, fuzzy, threshold)
+    terms = positive_terms(current_index, node, fuzzy, threshold)
+    if ranked and terms:
+        ids, scores = current_index.bm25(terms)
+        scored = {idx: score for idx, score in zip(ids.tolist() if np is not None else ids, scores) if idx in matched}
+        # Matches through filters or NOT alone contain none of the terms and rank last.
+        hits = sorted(scored.items(), key=lambda h: (-h[1], h[0]))
+        return hits + [(idx, 0.0) for idx in sorted(matched) if idx not in scored], terms
+    return [(idx, None) for idx in sorted(matched)], terms
+
+
+def search_result(results, items, query: str, index_name: str, next_offset: int = None):
+    """
+    Tool result for search_index: the rendered hits plus the same hits as structuredContent,
+    with next_offset set when more hits follow the page.
+    """
     if not results:
-        return [{"type": "text", "text": f"No results found for query: '{query}' in index '{index_name}'"}]
+        text = f"No results found for query: '{query}' in index '{index_name}'"
+    else:
+        text = "\n\n".join(results)
+    if next_offset is not None:
+        text += f"\n\n[more results from offset={next_offset}]"
+    return {"content": [{"type": "text", "text": text}], "structuredContent": {"results": items, "next_offset": next_offset}}
+
+def federated_hits(names, query: str, k: int, fuzzy: bool = False, threshold: float = 0.5, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None):
+    """
+    BM25 search of several indexes concurrently, each contributing its own top k.
+    Returns (normalized score, index name, index, chunk id) hits sorted best-first, with
+    scores divided by each index's best hit (ties keep the order of names), and the
+    names of indexes that could not be searched.
+    """
+    q_lower = (query or "").lower()
+    path_filter = (path_contains or "").lower()
+    tag_filter = (tag or "").lower()
+
+    def search_one(name):
+        current_index = get_index(name)
+        allowed = current_index.select(path_filter, tag_filter, min_mtime, max_mtime)
+        hits = rank_chunks(current_index, q_lower, fuzzy, threshold, allowed, k)
+        best = hits[0][1] if hits else 0.0
+        return [(score / best if best > 0 else 0.0, name, current_index, idx) for idx, score in hits]
+
+    merged = []
+    skipped = []
+    with ThreadPoolExecutor(max_workers=min(len(names), REQUEST_WORKERS)) as pool:
+        futures = [(name, pool.submit(search_one, name)) for name in names]
+        for name, future in futures:
+            check_cancelled()
+            try:
+                merged.extend(future.result())
+            except RequestCancelled:
+                raise
+            except Exception as e:
+                logging.warning(f"Skipped index '{name}': {e}")
+                skipped.append(name)
+    merged.sort(key=lambda hit: -hit[0])
+    return merged, skipped
+
+
+def all_index_names():
+    with index_lock:
+        return list(dict.fromkeys([*index_manifest, *file_indexes]))
+
+
+def search_all(query: str, index_names: list = None, limit: int = 10, fuzzy: bool = False, threshold: float = 0.5, path_contains: str = "", tag: str = "", min_mtime: float = None, max_mtime: float = None, snippet_width: int = SNIPPET_WIDTH):
+    """
+    Ranked search over several indexes at once (all of them by default). Each index is
+    searched concurrently with BM25; scores are normalized per index (best hit = 1.0),
+    then merged into one top-k list in which a chunk found in several indexes appears once.
+    """
+    names = list(index_names or all_index_names())
+    if not names:
+        return [{"type": "text", "text": "No indexes available. Create one with create_index."}]
+    k = max(1, int(limit or 10))
+    merged, skipped = federated_hits(names, query, k, fuzzy, threshold, path_contains, tag, min_mtime, max_mtime)
+    if fuzzy:
+        # The first fuzzy search of an index builds its deletion table, which counts toward the budget.
+        enforce_memory_budget()
+
+    results = []
+    items = []
+    seen = set()
+    terms = {}
+    for norm, name, current_index, idx in merged:
+        chunks = current_index.chunks
+        text = current_index.text(idx)
+        key = (chunks.path(idx), text)
+        if key in seen:
+            continue
+        seen.add(key)
+        if name not in terms:
+            terms[name] = query_terms(current_index, (query or "").lower(), fuzzy, threshold)
+        spans = current_index.match_spans(idx, text, terms[name])
+        snippet, item = snippet_hit(name, current_index, idx, text, spans, snippet_width, norm)
+        results.append(f"[{name}] [{chunks.path(idx)}] chunk {chunks.chunk_id[idx]} (score {norm:.3f})\n{snippet}\n")
+        items.append(item)
+        if len(results) >= k:
+            break
+
+    text = "\n\n".join(results) if results else f"No results found for query: '{query}' in {len(names) - len(skipped)} indexes"
+    if skipped:
+        text += f"\n\nSkipped indexes (check server logs for details): {', '.join(skipped)}"
+    return {"content": [{"type": "text", "text": text}], "structuredContent": {"results": items, "skipped": skipped}}
+
+
+def get_context(query: str, token_budget: int = 2000, index_names: list = None, fuzzy: bool = False, threshold: float = 0.5, path_contains: str = "", tag: str = ""):
+    """
+    Assemble ready-to-use context for a query within a token budget. The best BM25 chunks
+    (across index_names, default all) are grouped by file, overlapping or adjacent chunks
+    are merged into one passage (so the chunk overlap is not repeated), and passages are
+    packed best-first until the budget (estimated at CHARS_PER_TOKEN characters per
+    token) is spent. Each passage is numbered and cited with its file and chunk range.
+    """
+    budget = 2000 if token_budget is None else int(token_budget)
+    if budget < 1:
+        raise ValueError("token_budget must be at least 1.")
+    names = list(index_names or all_index_names())
+    if not names:
+        return [{"type": "text", "text": "No indexes available. Create one with create_index."}]
+    # Enough candidates to fill the budget even when every chunk is a full CHUNK_WORDS chunk.
+    k = max(8, budget // (CHUNK_WORDS * 4 // 3) * 2 + 4)
+    merged, skipped = federated_hits(names, query, k, fuzzy, threshold, path_contains, tag)
+
+    # Merge each file's hits into passages of touching byte ranges in the index's text store.
+    by_file = {}
+    for norm, name, current_index, idx in merged:
+        by_file.setdefault((name, current_index.chunks.path(idx)), (current_index, []))[1].append((idx, norm))
+    passages = []
+    for (name, path), (current_index, hits) in by_file.items():
+        chunks = current_index.chunks
+        hits.sort(key=lambda hit: chunks.start[hit[0]])
+        group = None
+        for idx, norm in hits:
+            start, end = chunks.start[idx], chunks.end[idx]
+            if group is not None and start <= group["end"] + 1:
+                group["end"] = max(group["end"], end)
+                group["last"] = chunks.chunk_id[idx]
+                group["score"] = max(group["score"], norm)
+                continue
+            group = {"name": name, "path": path, "index": current_index, "start": start, "end": end,
+                     "first": chunks.chunk_id[idx], "last": chunks.chunk_id[idx], "score": norm}
+            passages.append(group)
+    passages.sort(key=lambda p: -p["score"])
+
+    blocks = []
+    seen = set()
+    used = 0
+    for passage in passages:
+        text = passage["index"].store.text(passage["start"], passage["end"])
+        if (passage["path"], text) in seen:
+            continue
+        seen.add((passage["path"], text))
+        tokens = math.ceil(len(text) / CHARS_PER_TOKEN)
+        if used + tokens > budget:
+            room = (budget - used) * CHARS_PER_TOKEN - len(" ...")
+            if room < 64 * CHARS_PER_TOKEN:
+                continue
+            # Trim the passage to the remaining budget at a word boundary.
+            text = text[:room].rsplit(" ", 1)[0] + " ..."
+            tokens = math.ceil(len(text) / CHARS_PER_TOKEN)
+        chunk_range = f"chunk {passage['first']}" if passage["first"] == passage["last"] else f"chunks {passage['first']}-{passage['last']}"
+        blocks.append(f"[{len(blocks) + 1}] {passage['path']} ({chunk_range}, index '{passage['name']}')\n{text}")
+        used += tokens
+        if used >= budget:
+            break
+
+    if not blocks:
+        return [{"type": "text", "text": f"No context found for query: '{query}'"}]
+    text = "\n\n".join(blocks) + f"\n\n(~{used} of {budget} tokens, {len(blocks)} passages)"
+    if skipped:
+        text += f"\nSkipped indexes (check server logs for details): {', '.join(skipped)}"
+    return [{"type": "text", "text": text}]
+
+def find_duplicates(index_name: str, threshold: float = DUPLICATE_THRESHOLD, limit: int = 20):
+    """
+    Lists groups of near-duplicate chunks in an index, largest first: chunks whose sets
+    of words have an estimated Jaccard similarity of at least threshold (MinHash + LSH).
+    """
+    if np is None:
+        raise ValueError("find_duplicates needs NumPy, which is not installed.")
+    current_index = get_index(index_name)
+    chunks = current_index.chunks
+    clusters = current_index.duplicate_clusters(float(threshold if threshold is not None else DUPLICATE_THRESHOLD))
+    if not clusters:
+        return {"content": [{"type": "text", "text": f"No near-duplicate chunks found in index '{index_name}'."}],
+                "structuredContent": {"clusters": [], "redundant": 0}}
+    signatures = current_index.signatures()
+    redundant = sum(len(group) - 1 for group in clusters)
+    lines = [f"{len(clusters)} groups of near-duplicate chunks in index '{index_name}' ({redundant} redundant chunks):"]
+    items = []
+    for number, group in enumerate(clusters[:max(1, int(limit or 20))], 1):
+        similarity = float((signatures[group[1:]] == signatures[group[0]]).mean(axis=1).min())
+        members = [{"path": chunks.path(idx), "chunk_id": chunks.chunk_id[idx]} for idx in group]
+        items.append({"chunks": members, "similarity": round(similarity, 3)})
+        lines.append(f"\n{number}. {len(group)} chunks, >= {similarity:.0%} similar:")
+        lines.extend(f"   - [{m['path']}] chunk {m['chunk_id']}" for m in members)
+    if len(clusters) > len(items):
+        lines.append(f"\n({len(clusters) - len(items)} more groups not shown)")
+    return {"content": [{"type": "text", "text": "\n".join(lines)}],
+            "structuredContent": {"clusters": items, "redundant": redundant}}
 
-    return [{"type": "text", "text": "\n\n".join(results)}]
 
 def list_indexes():
-    """Lists all available index names."""
-    names = list(file_indexes.keys())
+    """Lists all available index names with their load state (loaded, on disk, or evicted)."""
+    with index_lock:
+        names = list(dict.fromkeys([*index_manifest, *file_indexes]))
+        lines = []
+        for name in names:
+            if name in file_indexes:
+                state = "loaded"
+                chunks = len(file_indexes[name].chunks)
+            else:
+                state = "evicted" if name in evicted_indexes else "on disk"
+                chunks = index_manifest[name].get("chunks", 0)
+            lines.append(f"{name} ({state}, {chunks} chunks)")
     if not names:
         return [{"type": "text", "text": "No indexes available. Create one with create_index."}]
-    return [{"type": "text", "text": "Indexes:\n- " + "\n- ".join(names)}]
+    text = "Indexes:\n- " + "\n- ".join(lines)
+    rss = current_rss()
+    if MEMORY_BUDGET_MB:
+        used = f"{rss / (1024 * 1024):.1f} MB" if rss is not None else "unknown"
+        text += f"\nMemory: {used} resident of {MEMORY_BUDGET_MB:g} MB budget"
+    if RESULT_CACHE_MB > 0:
+        text += f"\nResult cache: {result_cache.stats()}"
+    return [{"type": "text", "text": text}]
+
+
+def glob_keep(name: str, pattern: str = "", exclude: str = "") -> bool:
+    """list_files glob filters: name matches pattern (if any) and does not match exclude."""
+    return (not pattern or fnmatch.fnmatch(name, pattern)) and not (exclude and fnmatch.fnmatch(name, exclude))
 
 
-def list_files(directory_path: str):
+def page_after(items, cursor, limit):
     """
-    Lists all files and subdirectories in a given directory.
+    The first `limit` items sorted after `cursor`, and the cursor for the next page (None
+    on the last page). items are (sort key, ...) tuples; only the page itself is sorted.
+    """
+    if cursor:
+        items = (item for item in items if item[0] > cursor)
+    page = heapq.nsmallest(limit + 1, items)
+    if len(page) > limit:
+        del page[limit:]
+        return page, page[-1][0]
+    return page, None
+
+
+def directory_totals(directory_path: str, pattern: str = "", exclude: str = ""):
+    """
+    Walk a tree once with os.scandir and return {relative dir: [files, bytes, total files,
+    total bytes]}, counting files that pass the glob filters; totals include subdirectories.
+    Excluded directories are not entered and, like os.walk, symlinked ones are not followed.
+    """
+    stats = {}
+    pending = [("", directory_path)]
+    while pending:
+        check_cancelled()
+        rel, current = pending.pop()
+        counts = stats[rel] = [0, 0, 0, 0]
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if glob_keep(entry.name, exclude=exclude):
+                                pending.append((os.path.join(rel, entry.name), entry.path))
+                        elif glob_keep(entry.name, pattern, exclude):
+                            counts[0] += 1
+                            counts[1] += entry.stat().st_size
+                    except OSError as e:
+                        logging.warning(f"Skipping '{entry.path}': {e}")
+        except OSError as e:
+            logging.warning(f"Skipping directory '{current}': {e}")
+    # Children sort after their parents, so one reverse pass rolls totals up the tree.
+    for rel in sorted(stats, reverse=True):
+        counts = stats[rel]
+        counts[2] += counts[0]
+        counts[3] += counts[1]
+        if rel:
+            parent = stats[os.path.dirname(rel)]
+            parent[2] += counts[2]
+            parent[3] += counts[3]
+    return stats
+
+
+def list_files(directory_path: str, pattern: str = "", exclude: str = "", limit: int = LIST_PAGE_SIZE, cursor: str = "", recursive: bool = False):
+    """
+    Lists the files and subdirectories in a directory, one page at a time, sorted by name.
+    pattern/exclude are glob filters on names. With recursive=True it instead lists every
+    directory in the tree with its file count and byte total, computed in one walk.
     """
     directory_path = normalize_path(directory_path)
     if not os.path.isdir(directory_path):
         raise FileNotFoundError(f"The directory '{directory_path}' does not exist.")
-    
+    limit = max(1, int(limit or LIST_PAGE_SIZE))
+
     try:
-        entries = os.listdir(directory_path)
-        if not entries:
-            return [{"type": "text", "text": f"The directory '{directory_path}' is empty."}]
-        
-        # Annotate entries with [D] for directory and [F] for file
-        annotated_entries = []
-        for entry in sorted(entries):
-            entry_path = os.path.join(directory_path, entry)
-            if os.path.isdir(entry_path):
-                annotated_entries.append(f"[D] {entry}")
-            else:
-                annotated_entries.append(f"[F] {entry}")
-        
-        content = f"Contents of '{directory_path}':\n" + "\n".join(annotated_entries)
-        return [{"type": "text", "text": content}]
+        if recursive:
+            stats = directory_totals(directory_path, pattern, exclude)
+            rows = ((rel or ".", *counts) for rel, counts in stats.items() if counts[2] or not pattern)
+            page, next_cursor = page_after(rows, cursor, limit)
+            entries = [{"path": rel, "files": files, "bytes": size, "total_files": total_files, "total_bytes": total_bytes}
+                       for rel, files, size, total_files, total_bytes in page]
+            lines = [f"[D] {e['path']}: {e['files']} files, {e['bytes']} bytes "
+                     f"(with subdirectories: {e['total_files']} files, {e['total_bytes']} bytes)" for e in entries]
+            header = f"Directory tree of '{directory_path}'" + (f" (files matching '{pattern}')" if pattern else "") + ":"
+        else:
+            with os.scandir(directory_path) as it:
+                # is_dir() uses the d_type scandir already returned: no stat per entry.
+                rows = [(entry.name, entry.is_dir()) for entry in it if glob_keep(entry.name, pattern, exclude)]
+            page, next_cursor = page_after(rows, cursor, limit)
+            entries = [{"name": name, "type": "directory" if is_dir else "file"} for name, is_dir in page]
+            lines = [f"[{'D' if e['type'] == 'directory' else 'F'}] {e['name']}" for e in entries]
+            header = f"Contents of '{directory_path}':"
+    except RequestCancelled:
+        raise
     except Exception as e:
         raise RuntimeError(f"An error occurred while listing the directory: {e}")
 
-def read_file(file_path: str):
+    if not entries:
+        if cursor or pattern or exclude:
+            text = f"No more entries in '{directory_path}' match the given filters."
+        else:
+            text = f"The directory '{directory_path}' is empty."
+    else:
+        text = header + "\n" + "\n".join(lines)
+        if next_cursor is not None:
+            text += f"\n(more entries: continue with cursor='{next_cursor}')"
+    return {
+        "content": [{"type": "text", "text": text}],
+        "structuredContent": {"directory": directory_path, "entries": entries, "next_cursor": next_cursor},
+    }
+
+def line_offset(data, line: int) -> int:
     """
-    Reads the content of a specific file from the filesystem.
+    Byte offset where 1-based line `line` starts in data (its size if the file is
+    shorter). Lines end at \r\n, \r or \n, the breaks read_file returns as \n.
+    """
+    pos, remaining = 0, line - 1
+    while remaining > 0 and pos < len(data):
+        block = data[pos:pos + STREAM_BLOCK_SIZE]
+        if block.endswith(b"\r") and data[pos + len(block):pos + len(block) + 1] == b"\n":
+            block += b"\n"  # keep a \r\n in one block
+        breaks = block.count(b"\n") + block.count(b"\r") - block.count(b"\r\n")
+        if breaks < remaining:
+            remaining -= breaks
+            pos += len(block)
+            continue
+        match = next(itertools.islice(LINE_BREAK_RE.finditer(block), remaining - 1, None))
+        return pos + match.end()
+    return min(pos, len(data))
+
+
+def char_boundary(data, pos: int) -> int:
+    """Moves pos back to the start of the UTF-8 character it falls inside."""
+    for _ in range(3):
+        if 0 < pos < len(data) and data[pos] & 0xC0 == 0x80:
+            pos -= 1
+    return pos
+
+
+def read_file(file_path: str, offset: int = None, length: int = None, start_line: int = None, end_line: int = None):
+    """
+    Reads a text file, or a byte range or line range of it.
+
+    The file is memory-mapped and only the requested range is decoded, at most
+    READ_MAX_BYTES per call. When more of the file remains, the result says where to
+    continue (next_offset, and next_line for line reads). Line endings are returned
+    as \n, as a text-mode open() would; offsets still count bytes of the file.
     """
     file_path = normalize_path(file_path)
     if not os.path.isfile(file_path):
         raise FileNotFoundError(f"The file '{file_path}' does not exist.")
-    
+    if offset is not None and start_line is not None:
+        raise ValueError("Use either offset or start_line, not both.")
+    if (offset is not None and offset < 0) or (length is not None and length < 0):
+        raise ValueError("offset and length must not be negative.")
+    if (start_line is not None and start_line < 1) or (end_line is not None and end_line < (start_line or 1)):
+        raise ValueError("Lines are numbered from 1 and end_line must not precede start_line.")
+
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return [{"type": "text", "text": content}]
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            by_line = offset is None and (start_line is not None or end_line is not None)
+            start = line_offset(data, start_line) if start_line is not None else min(offset or 0, size)
+            if length is not None:
+                end = min(start + length, size)
+            elif end_line is not None:
+                end = line_offset(data, end_line + 1)
+            else:
+                end = size
+            end = wanted = max(start, end)
+            if end - start > READ_MAX_BYTES:
+                end = start + READ_MAX_BYTES
+                if by_line:
+                    # Page on whole lines unless a single line is longer than a page.
+                    cut = max(data.rfind(b"\n", start, end), data.rfind(b"\r", start, end))
+                    end = cut + 1 if cut >= 0 else end
+            # Never split a UTF-8 character or a \r\n at either end of the range.
+            start = char_boundary(data, start)
+            end = max(start, char_boundary(data, end))
+            if 0 < start < size and data[start - 1:start + 1] == b"\r\n":
+                start += 1
+                end = max(start, end)
+            if start < end < size and data[end - 1:end + 1] == b"\r\n":
+                end += 1
+            truncated = end < wanted
+            content = data[start:end].decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
     except Exception as e:
         raise RuntimeError(f"An error occurred while reading the file: {e}")
 
+    info = {"path": file_path, "size": size, "offset": start, "end": end, "next_offset": end if end < size else None, "text": content}
+    if by_line:
+        lines = content.count("\n") + (1 if content and not content.endswith("\n") else 0)
+        info["start_line"] = start_line or 1
+        info["end_line"] = info["start_line"] + lines - 1
+        whole_lines = end < size and (not content or content.endswith("\n"))
+        info["next_line"] = info["end_line"] + 1 if whole_lines else None
+    text = content
+    if truncated and by_line and info["next_line"] is not None:
+        text += f"\n[lines {info['start_line']}-{info['end_line']} of {file_path}; more from start_line={info['next_line']}]"
+    elif truncated:
+        text += f"\n[bytes {start}-{end} of {size}; more from offset={end}]"
+    return {"content": [{"type": "text", "text": text}], "structuredContent": info}
+
 
 def save_chat(transcript: str, model: str, summarize: bool = False, summary: str = "", session_id: str = ""):
     """
@@ -515,7 +3577,8 @@ if __name__ == "__main__":
             "type": "object",
             "properties": {
                 "index_name": {"type": "string", "description": "A unique name for this index collection."},
-                "directory_path": {"type": "string", "description": "The directory to index."}
+                "directory_path": {"type": "string", "description": "The directory to index."},
+                "collapse_duplicates": {"type": "boolean", "description": "Hide near-duplicate chunks from searches, keeping the first of each group.", "default": False}
             },
             "required": ["index_name", "directory_path"]
         }
@@ -531,24 +3594,93 @@ if __name__ == "__main__":
                 "index_name": {"type": "string", "description": "The name of the index collection to search."},
                 "query": {"type": "string", "description": "The keyword to search for."},
                 "fuzzy": {"type": "boolean", "description": "Enable fuzzy match.", "default": False},
-                "threshold": {"type": "number", "description": "Fuzzy match threshold (0-1).", "default": 0.6},
+                "threshold": {"type": "number", "description": "Fuzzy match threshold (0-1): a query word of n characters matches words up to (1 - threshold) * n / 2 edits away (at most 2).", "default": 0.6},
                 "path_contains": {"type": "string", "description": "Filter: path contains substring."},
                 "tag": {"type": "string", "description": "Filter: tag must match (from #tags line)."},
                 "min_mtime": {"type": "number", "description": "Filter: minimum modified time (epoch seconds)."},
-                "max_mtime": {"type": "number", "description": "Filter: maximum modified time (epoch seconds)."}
+                "max_mtime": {"type": "number", "description": "Filter: maximum modified time (epoch seconds)."},
+                "ranked": {"type": "boolean", "description": "Rank chunks containing any query word by BM25 and show scores.", "default": False},
+                "limit": {"type": "integer", "description": f"Maximum number of results to return (top-k when ranked); default {SEARCH_PAGE_SIZE} in keyword mode and {VECTOR_TOP_K} in vector/hybrid mode."},
+                "offset": {"type": "integer", "description": "Number of results to skip, for paging (e.g. next_offset from the previous page).", "default": 0},
+                "regex": {"type": "boolean", "description": "Treat query as a case-insensitive regular expression (fuzzy/ranked are ignored).", "default": False},
+                "snippet_width": {"type": "integer", "description": "Snippet length in characters, centred on the matches.", "default": SNIPPET_WIDTH},
+                "mode": {"type": "string", "enum": list(SEARCH_MODES), "description": "keyword: literal/fuzzy/regex/BM25 matching; vector: similarity of hashed TF-IDF vectors of words and their character trigrams, which also finds related word forms; hybrid: BM25 and vector rankings fused by reciprocal rank fusion.", "default": "keyword"},
+                "dedupe": {"type": "boolean", "description": "Drop hits that are near-duplicates of a better hit.", "default": False},
+                "boolean": {"type": "boolean", "description": "Treat query as a boolean query over whole words: AND, OR, NOT (upper case; adjacent terms are ANDed), parentheses, \"quoted phrases\" and path:, tag:, after: and before: filters (dates as YYYY-MM-DD or epoch seconds), e.g. kubernetes AND upgrade NOT helm after:2024-01-01. Keyword mode only.", "default": False}
             },
             "required": ["index_name", "query"]
         }
     )
 
+    mcp_server.register_tool(
+        name="search_all",
+        description="Ranked search across several indexes (all by default) in one call; returns one merged, deduplicated top-k list.",
+        func=search_all,
+        input_schema={
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "The keywords to search for."},
+                "index_names": {"type": "array", "items": {"type": "string"}, "description": "Indexes to search (default: all)."},
+                "limit": {"type": "integer", "description": "Number of merged results to return.", "default": 10},
+                "fuzzy": {"type": "boolean", "description": "Also match vocabulary words close to the query words.", "default": False},
+                "threshold": {"type": "number", "description": "Fuzzy match threshold (0-1): a query word of n characters matches words up to (1 - threshold) * n / 2 edits away (at most 2).", "default": 0.6},
+                "path_contains": {"type": "string", "description": "Filter: path contains substring."},
+                "tag": {"type": "string", "description": "Filter: tag must match (from #tags line)."},
+                "min_mtime": {"type": "number", "description": "Filter: minimum modified time (epoch seconds)."},
+                "max_mtime": {"type": "number", "description": "Filter: maximum modified time (epoch seconds)."},
+                "snippet_width": {"type": "integer", "description": "Snippet length in characters, centred on the matches.", "default": SNIPPET_WIDTH}
+            },
+            "required": ["query"]
+        }
+    )
+
+    mcp_server.register_tool(
+        name="get_context",
+        description="Builds context for a query within a token budget: best chunks across indexes, merged per file and cited.",
+        func=get_context,
+        input_schema={
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "What the context should be about."},
+                "token_budget": {"type": "integer", "description": "Approximate maximum number of tokens to return.", "default": 2000},
+                "index_names": {"type": "array", "items": {"type": "string"}, "description": "Indexes to draw from (default: all)."},
+                "fuzzy": {"type": "boolean", "description": "Also match vocabulary words close to the query words.", "default": False},
+                "threshold": {"type": "number", "description": "Fuzzy match threshold (0-1): a query word of n characters matches words up to (1 - threshold) * n / 2 edits away (at most 2).", "default": 0.6},
+                "path_contains": {"type": "string", "description": "Filter: path contains substring."},
+                "tag": {"type": "string", "description": "Filter: tag must match (from #tags line)."}
+            },
+            "required": ["query"]
+        }
+    )
+
+    mcp_server.register_tool(
+        name="find_duplicates",
+        description="Finds groups of near-duplicate chunks in an index (MinHash/LSH over each chunk's words).",
+        func=find_duplicates,
+        input_schema={
+            "type": "object",
+            "properties": {
+                "index_name": {"type": "string", "description": "The index to check."},
+                "threshold": {"type": "number", "description": "Minimum estimated Jaccard similarity (0-1) of two chunks' word sets.", "default": DUPLICATE_THRESHOLD},
+                "limit": {"type": "integer", "description": "Maximum number of groups to list.", "default": 20}
+            },
+            "required": ["index_name"]
+        }
+    )
+
     mcp_server.register_tool(
         name="list_files",
-        description="Lists all files and subdirectories within a specified directory on the local filesystem.",
+        description="Lists files and subdirectories of a directory (paged, with glob filters), or with recursive=true every directory in the tree with file counts and byte totals.",
         func=list_files,
         input_schema={
             "type": "object",
             "properties": {
-                "directory_path": {"type": "string", "description": "The absolute or relative path to the directory."}
+                "directory_path": {"type": "string", "description": "The absolute or relative path to the directory."},
+                "pattern": {"type": "string", "description": "Glob on entry names to include, e.g. '*.md'."},
+                "exclude": {"type": "string", "description": "Glob on entry names to leave out (in recursive mode, matching directories are skipped)."},
+                "limit": {"type": "integer", "description": "Maximum number of entries per page.", "default": LIST_PAGE_SIZE},
+                "cursor": {"type": "string", "description": "next_cursor from the previous page."},
+                "recursive": {"type": "boolean", "description": "List every directory in the tree with its file count and byte total.", "default": False}
             },
             "required": ["directory_path"]
         }
@@ -556,7 +3688,7 @@ if __name__ == "__main__":
 
     mcp_server.register_tool(
         name="list_indexes",
-        description="Lists all available in-memory indexes.",
+        description="Lists all available indexes and whether each is loaded, on disk, or evicted.",
         func=list_indexes,
         input_schema={
             "type": "object",
@@ -567,12 +3699,16 @@ if __name__ == "__main__":
 
     mcp_server.register_tool(
         name="read_file",
-        description="Reads the entire content of a specified text file.",
+        description="Reads a text file, or a byte or line range of it; large files are returned in pages with a continuation cursor.",
         func=read_file,
         input_schema={
             "type": "object",
             "properties": {
-                "file_path": {"type": "string", "description": "The absolute or relative path to the file."}
+                "file_path": {"type": "string", "description": "The absolute or relative path to the file."},
+                "offset": {"type": "integer", "description": "Byte offset to start reading at (e.g. next_offset from the previous page)."},
+                "length": {"type": "integer", "description": "Number of bytes to read (capped per call)."},
+                "start_line": {"type": "integer", "description": "First line to read, numbered from 1."},
+                "end_line": {"type": "integer", "description": "Last line to read, inclusive."}
             },
             "required": ["file_path"]
         }